@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import logging
+import os
+import ssl
+import subprocess
+import tempfile
+import time
+import oblique
+
+DESCRIPTION = "Tunnel throughput (plaintext vs TLS) and TLS reconnect latency (full handshake vs resumed session) " \
+              "over loopback."
+
+SERVER_HOST = "127.0.0.1"
+CHUNK = 64 * 1024
+
+
+def make_contexts(cert: str=None, key: str=None):
+    """
+    Create server and client SSLContexts. A self-signed certificate is generated with the openssl CLI if none is
+    provided.
+    """
+    if cert is None:
+        tmp = tempfile.mkdtemp()
+        cert, key = os.path.join(tmp, "cert.pem"), os.path.join(tmp, "key.pem")
+        subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                               "-subj", "/CN=localhost", "-keyout", key, "-out", cert],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    server = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    server.load_cert_chain(cert, key)
+    client = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+    client.check_hostname = False
+    client.verify_mode = ssl.CERT_NONE
+    return server, client
+
+
+async def sink(reader, writer):
+    total = 0
+    while True:
+        data = await reader.read(CHUNK)
+        if not data:
+            break
+        total += len(data)
+    writer.write(str(total).encode())
+    writer.close()
+
+
+async def wait_ready(client):
+    while not client.listen_port:
+        await asyncio.sleep(0.001)
+
+
+async def throughput(dest_port, server_port, sessions, size, server_ssl=None, client_ssl=None):
+    group = await oblique.create_server(host=SERVER_HOST, port=server_port, ssl=server_ssl)
+    transport, client = await oblique.create_client(SERVER_HOST, dest_port, SERVER_HOST, server_port,
+                                                    ssl=client_ssl)
+    await wait_ready(client)
+    payload = os.urandom(CHUNK)
+
+    async def session():
+        reader, writer = await asyncio.open_connection(SERVER_HOST, client.listen_port)
+        for _ in range(size // CHUNK):
+            writer.write(payload)
+            await writer.drain()
+        writer.write_eof()
+        received = int(await reader.read())
+        writer.close()
+        return received
+
+    start = time.perf_counter()
+    received = await asyncio.gather(*[session() for _ in range(sessions)])
+    elapsed = time.perf_counter() - start
+    transport.close()
+    group.close()
+    await group.wait_closed()
+    if sum(received) != sessions * (size // CHUNK) * CHUNK:
+        raise RuntimeError("Sink received {} bytes".format(sum(received)))
+    return sum(received) / elapsed / 1e6
+
+
+async def reconnects(dest_port, server_port, count, server_ssl, client_ssl_factory):
+    group = await oblique.create_server(host=SERVER_HOST, port=server_port, ssl=server_ssl)
+    timings = []
+    for _ in range(count):
+        client_ssl = client_ssl_factory()
+        start = time.perf_counter()
+        transport, client = await oblique.create_client(SERVER_HOST, dest_port, SERVER_HOST, server_port,
+                                                        ssl=client_ssl)
+        timings.append(time.perf_counter() - start)
+        await wait_ready(client)
+        transport.close()
+    group.close()
+    await group.wait_closed()
+    return sum(timings[1:]) / (count - 1) * 1000
+
+
+async def main(args):
+    server_ssl, client_ssl = make_contexts(args.cert, args.key)
+    dest = await asyncio.start_server(sink, SERVER_HOST, 0)
+    dest_port = dest.sockets[0].getsockname()[1]
+    size = args.size * 1024 * 1024
+
+    plain = await throughput(dest_port, args.port, args.sessions, size)
+    tls = await throughput(dest_port, args.port + 1, args.sessions, size, server_ssl, client_ssl)
+    full = await reconnects(dest_port, args.port + 2, args.reconnects, server_ssl,
+                                 lambda: ssl_client(client_ssl))
+    resumed = await reconnects(dest_port, args.port + 3, args.reconnects, server_ssl, lambda: client_ssl)
+
+    print("{} sessions x {} MiB, {}".format(args.sessions, args.size, ssl.OPENSSL_VERSION))
+    print("Throughput  plaintext: {:8.1f} MB/s".format(plain))
+    print("Throughput  TLS:       {:8.1f} MB/s ({:.0f}%)".format(tls, 100 * tls / plain))
+    print("Reconnect   full:      {:8.2f} ms".format(full))
+    print("Reconnect   resumed:   {:8.2f} ms".format(resumed))
+    dest.close()
+
+
+def ssl_client(template: ssl.SSLContext) -> ssl.SSLContext:
+    """
+    A fresh client context (empty session cache) with the same verification settings as `template`
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = template.check_hostname
+    context.verify_mode = template.verify_mode
+    return context
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument("--sessions", type=int, default=8)
+    parser.add_argument("--size", type=int, default=32, help="MiB sent per session")
+    parser.add_argument("--reconnects", type=int, default=50)
+    parser.add_argument("--port", type=int, default=18100, help="first of 4 consecutive server ports")
+    parser.add_argument("--cert")
+    parser.add_argument("--key")
+    parser.add_argument("--no-uvloop", action="store_true",
+                        help="use the asyncio event loop even if uvloop is installed")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    oblique.run(main(args), use_uvloop=not args.no_uvloop)
@@ -1,30 +1,21 @@
 #!/usr/bin/env python3
-import asyncio
-try:
-    import uvloop
-    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
-except ImportError as e:
-    print("Running without uvloop")
-
 import oblique
 
 SERVER_HOST = "127.0.0.1"
 SERVER_PORT = 8000
 
 
-@asyncio.coroutine
-def main(loop):
+async def main():
     try:
-        yield from oblique.create_server(port=8000, loop=loop)
-        yield from oblique.create_client("127.0.0.1", 1234, SERVER_HOST, SERVER_PORT, loop=loop)
+        group = await oblique.create_server(port=SERVER_PORT)
+        _, client = await oblique.create_client("127.0.0.1", 1234, SERVER_HOST, SERVER_PORT)
     except Exception as e:
         print(e)
+        return
+    await client.wait_closed()
+    group.close()
+    await group.wait_closed()
 
 
 if __name__ == "__main__":
-    loop = asyncio.get_event_loop()
-    try:
-        loop.run_until_complete(main(loop))
-        loop.run_forever()
-    finally:
-        loop.close()
+    oblique.run(main())
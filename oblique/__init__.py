@@ -4,4 +4,7 @@ from . import utils
 from . import listener
 from .server import create_server
 from .client import create_client
-from .commands import Command, Mode
+from .commands import Command, Mode, Tunnel
+from .congestion import CongestionControl, NewReno, FixedWindow
+from .limits import Limits
+from .runtime import run
@@ -4,9 +4,12 @@ import struct
 import threading
 from abc import ABC, abstractmethod
 from contextlib import suppress
+from itertools import groupby
 from logging import Logger
 from typing import Union
+from oblique.commands import Command, compose_batch, parse_partial
 from oblique.log import make_logger
+from oblique.tls import RECORD_SIZE
 
 __all__ = [
     "BaseLoggable", "BaseSession", "BaseSessionTracking", "BaseComponent",
@@ -36,6 +39,9 @@ class BaseSession(ABC):
     """
     Base sender class. Anything that implements the .send() method.
     """
+    transport = None
+    read_closed = False     # EOF received from our socket and forwarded through the tunnel
+    write_closed = False    # EOF received through the tunnel and written to our socket
     @abstractmethod
     def send(self, data: bytes) -> None:
         """
@@ -50,6 +56,25 @@ class BaseSession(ABC):
         :return: None
         """
 
+    def send_eof(self) -> None:
+        """
+        The other end of the tunnel finished sending. Half-close our socket but keep reading from it.
+        :return: None
+        """
+        self.write_closed = True
+        if self.transport.can_write_eof():
+            self.transport.write_eof()
+        self.check_closed()
+
+    def check_closed(self) -> None:
+        """
+        Close the connection once both directions have finished. The transport flushes its write buffer before the
+        socket is actually closed, and connection_lost frees the session afterwards.
+        :return: None
+        """
+        if self.read_closed and self.write_closed:
+            self.transport.close()
+
 
 class BaseSessionTracking(object):
     """
@@ -100,15 +125,171 @@ class BaseComponent(asyncio.Protocol, BaseSessionTracking, BaseLoggable):
     Common base class for Oblique Servers and Clients.
     """
 
-    def __init__(self, loop: asyncio.AbstractEventLoop=None):
+    def __init__(self, loop: asyncio.AbstractEventLoop=None, batch_window: float=0.002):
         """
         Implements everything the main Client/Server components share
 
         :param loop: asyncio event loop
+        :param batch_window: seconds to aggregate open/dead control packets before sending them as a batch
         """
         super().__init__()
-        self.loop = loop or asyncio.get_event_loop()
+        self.loop = loop or asyncio.get_running_loop()
         self.transport = None
+        self.tasks = set()
+        self.batch_window = batch_window
+        self.control = []
+        self.control_handle = None
+        self.inbound = bytearray()
+        self.record_size = None
+        self.outgoing = []
+        self.outgoing_size = 0
+        self.outgoing_handle = None
+
+    def set_transport(self, transport: asyncio.BaseTransport) -> None:
+        """
+        Store the tunnel transport. Packets written to TLS transports are coalesced into full records.
+
+        :param transport: transport supplied by asyncio
+        :return: None
+        """
+        self.transport = transport
+        if transport.get_extra_info("ssl_object") is not None:
+            self.record_size = RECORD_SIZE
+
+    def spawn(self, coro) -> asyncio.Task:
+        """
+        Run a coroutine as a task owned by this component. Tasks still running when the tunnel connection is lost
+        are cancelled by cancel_tasks().
+
+        :param coro: the coroutine
+        :return: the task
+        """
+        task = self.loop.create_task(coro)
+        if not task.done():
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        return task
+
+    def cancel_tasks(self) -> None:
+        """
+        Cancel every task started with spawn()
+        :return: None
+        """
+        for task in list(self.tasks):
+            task.cancel()
+        self.tasks.clear()
+
+    def parse_stream(self, data: bytes) -> list:
+        """
+        Parse the complete packets received so far. An incomplete trailing packet is kept for the next read.
+
+        :param data: data supplied by asyncio
+        :return: the parsed (command, session ID, data) tuples
+        """
+        if not self.inbound:
+            packets, consumed = parse_partial(data)
+            self.inbound.extend(memoryview(data)[consumed:])
+            return packets
+        self.inbound.extend(data)
+        packets, consumed = parse_partial(self.inbound)
+        del self.inbound[:consumed]
+        return packets
+
+    def send_control(self, command: Command, session_id: int) -> None:
+        """
+        Queue an open or dead packet. Queued packets are sent once the batch window expires, or earlier if a data
+        packet has to go out first. They keep the order they were queued in; consecutive packets of the same
+        command are sent as a batch.
+
+        :param command: Command.open or Command.dead
+        :param session_id: the session ID the command applies to
+        :return: None
+        """
+        self.control.append((command, session_id))
+        if self.control_handle is None:
+            self.control_handle = self.loop.call_later(self.batch_window, self.flush_control)
+
+    def take_control(self, command: Command, session_id: int) -> bool:
+        """
+        Remove a queued control packet that has not been sent yet, e.g. so an open can be sent together with the
+        session's first data instead.
+
+        :param command: Command.open or Command.dead
+        :param session_id: the session ID the command applies to
+        :return: True if the packet was still queued
+        """
+        try:
+            self.control.remove((command, session_id))
+        except ValueError:
+            return False
+        if not self.control and self.control_handle is not None:
+            self.control_handle.cancel()
+            self.control_handle = None
+        return True
+
+    def flush_control(self) -> None:
+        """
+        Send every queued control packet
+        :return: None
+        """
+        if self.control_handle is not None:
+            self.control_handle.cancel()
+            self.control_handle = None
+        control, self.control = self.control, []
+        if self.transport is None or self.transport.is_closing():
+            return
+        for command, run in groupby(control, key=lambda packet: packet[0]):
+            self.emit(compose_batch(command, [session_id for _, session_id in run]))
+
+    def write(self, data: bytes) -> None:
+        """
+        Write a packet to the tunnel. Queued control packets are flushed first so an open is never overtaken by the
+        session's data.
+
+        :param data: a composed packet
+        :return: None
+        """
+        if self.control:
+            self.flush_control()
+        self.emit(data)
+
+    def emit(self, data: bytes) -> None:
+        """
+        Hand a packet to the transport. On TLS tunnels, packets written during the same loop iteration are joined so
+        they are encrypted as one record instead of one record per packet.
+
+        :param data: a composed packet
+        :return: None
+        """
+        if self.record_size is None:
+            self.transport.write(data)
+            return
+        self.outgoing.append(data)
+        self.outgoing_size += len(data)
+        if self.outgoing_size >= self.record_size:
+            self.flush_outgoing()
+        elif self.outgoing_handle is None:
+            self.outgoing_handle = self.loop.call_soon(self.flush_outgoing)
+
+    def flush_outgoing(self) -> None:
+        """
+        Write the coalesced packets
+        :return: None
+        """
+        if self.outgoing_handle is not None:
+            self.outgoing_handle.cancel()
+            self.outgoing_handle = None
+        outgoing, self.outgoing, self.outgoing_size = self.outgoing, [], 0
+        if outgoing and not self.transport.is_closing():
+            self.transport.write(b"".join(outgoing))
+
+    def flush(self) -> None:
+        """
+        Write everything queued, e.g. before closing the transport
+        :return: None
+        """
+        self.flush_control()
+        self.flush_outgoing()
 
 
 class BaseServer(BaseComponent):
@@ -1,11 +1,19 @@
 import asyncio
+import random
 import struct
 from contextlib import suppress
 from collections import defaultdict
 from functools import partial
-from oblique.commands import Command, Mode, compose, parse
+from ssl import SSLContext
+from typing import Callable
+from oblique.commands import Command, Mode, Tunnel, INIT_LEN, compose, parse_batch
 from oblique.bases import BaseClient
+from oblique.congestion import CongestionControl
+from oblique.datagram import open_tunnel
 from oblique.repeater import RepeaterTCP
+from oblique.tls import enable_resumption
+
+RECONNECT_JITTER = 2.0  # Spread reconnects after a drain so clients don't all handshake with the new server at once
 
 __all__ = ["Client", "create_client"]
 
@@ -13,30 +21,49 @@ __all__ = ["Client", "create_client"]
 class Client(BaseClient):
     transport = None
 
-    @asyncio.coroutine
-    def heartbeat(self):
-        try:
-            self.log.info("Heartbeat")
-            self.transport.write(compose(Command.beat, 0, None))
-        except Exception as e:
-            print(e)
-            self.log.critical(e)
-            self.transport.close()
-        else:
-            yield from asyncio.sleep(30)
-            asyncio.ensure_future(self.heartbeat(), loop=self.loop)
+    async def heartbeat(self, interval: float=30.0):
+        """
+        Send a heartbeat packet every `interval` seconds until the tunnel closes
 
-    def __init__(self, host: str, port: int, mode: Mode, loop: asyncio.AbstractEventLoop=None):
+        :param interval: seconds between heartbeats
+        :return: None
+        """
+        while not self.transport.is_closing():
+            try:
+                self.log.info("Heartbeat")
+                self.write(compose(Command.beat, 0, None))
+            except Exception as e:
+                print(e)
+                self.log.critical(e)
+                self.transport.close()
+                return
+            await asyncio.sleep(interval)
+
+    def __init__(self, host: str, port: int, mode: Mode, loop: asyncio.AbstractEventLoop=None,
+                 batch_window: float=0.002, listen_port: int=0, tunnel: Tunnel=Tunnel.tcp,
+                 congestion: Callable[[], CongestionControl]=None, ssl: SSLContext=None,
+                 response_window: float=0.1):
         self.host = host
         self.port = port
         self.mode = mode
+        self.listen_port = listen_port
+        self.tunnel = tunnel
+        self.congestion = congestion
+        self.ssl = ssl
+        self.response_window = response_window
+        self.server_hostname = None
+        self.peername = None
         self.buffers = defaultdict(list)
-        super().__init__(loop=loop)
+        self.eofs = set()
+        self.opening = dict()
+        super().__init__(loop=loop, batch_window=batch_window)
+        self.closed = self.loop.create_future()
+        self.replaced = None
 
     def try_send(self, session_id: int, data: bytes=None, retries: int=3, delay: float=0.25):
         """
-        Attempt to send data through a repeater. If no session exists, connection may not have fully opened.
-        Retry (3 times by default).
+        Attempt to send data through a repeater. Data for a repeater that is still connecting is buffered until it
+        connects. If no session exists, connection may not have fully opened. Retry (3 times by default).
 
         :param session_id: the repeater session ID
         :param data: data
@@ -47,9 +74,10 @@ class Client(BaseClient):
 
         if retries == 0:
             self.log.info("Max Retries. Session {:08x} unavailable.".format(session_id))
-            del self.buffers[session_id]
+            self.buffers.pop(session_id, None)
+            self.eofs.discard(session_id)
             self.del_session(session_id)
-            self.transport.write(compose(Command.dead, session_id, None))
+            self.send_control(Command.dead, session_id)
             return
 
         if data is not None:
@@ -57,6 +85,8 @@ class Client(BaseClient):
 
         repeater = self.get_session(session_id)
         if repeater is None:
+            if session_id in self.opening:
+                return
             self.log.info("Retrying Session {:08x}...".format(session_id))
             self.loop.call_later(delay, self.try_send, session_id, None, retries-1)
             return
@@ -69,55 +99,237 @@ class Client(BaseClient):
 
         self.buffers[session_id].clear()
 
+        if session_id in self.eofs:
+            self.eofs.discard(session_id)
+            repeater.send_eof()
+
+    def session_open(self, session_id: int, data: bytes=None) -> None:
+        """
+        The server accepted a new endpoint connection. Open a repeater to the destination for it.
+
+        :param session_id: the session ID
+        :param data: the endpoint's first data, sent along with the open packet
+        :return: None
+        """
+        if self.mode == Mode.tcp:
+            def tcp_open(conn):
+                if conn.cancelled():
+                    return
+                if conn.exception() is not None:
+                    self.opening.pop(session_id, None)
+                    with suppress(KeyError):
+                        del self.buffers[session_id]
+                    self.eofs.discard(session_id)
+                    self.del_session(session_id)
+                    self.send_control(Command.dead, session_id)
+            if data:
+                self.buffers[session_id].append(data)
+            task = self.spawn(
+                self.loop.create_connection(partial(RepeaterTCP, session_id, self), self.host, self.port)
+            )
+            task.add_done_callback(tcp_open)
+            self.opening[session_id] = task
+
+    def session_connected(self, session_id: int) -> bool:
+        """
+        A repeater connected to the destination. Deliver the data and EOF received while it was connecting.
+
+        :param session_id: the session ID
+        :return: True if the endpoint's data was delivered, i.e. a response may be on its way
+        """
+        self.opening.pop(session_id, None)
+        early = bool(self.buffers.get(session_id))
+        self.try_send(session_id)
+        return early
+
+    def session_dead(self, session_id: int) -> None:
+        """
+        The endpoint connection for a session died. Close the repeater, or stop it connecting and drop the data
+        buffered for it.
+
+        :param session_id: the session ID
+        :return: None
+        """
+        self.log.warning("Session {:08x} dead.".format(session_id))
+        task = self.opening.pop(session_id, None)
+        if task is not None:
+            task.cancel()
+            self.buffers.pop(session_id, None)
+            self.eofs.discard(session_id)
+            return
+        sess = self.get_session(session_id)
+        if sess is not None:
+            sess.close()
+
+    def reconnect(self, retries: int=5, delay: float=1.0) -> None:
+        """
+        Open a new connection to the server, asking for the same listener port. This connection keeps serving its
+        established sessions until the server closes it.
+
+        :param retries: number of retries to attempt
+        :param delay: delay, in seconds, before the first retry. Doubled after every attempt.
+        :return: None
+        """
+        def reconnected(fut):
+            if fut.cancelled():
+                self.replaced.set_result(None)
+                return
+            if fut.exception() is None:
+                self.replaced.set_result(fut.result()[1])
+                return
+            if retries == 0:
+                self.log.critical("Unable to reconnect: {}".format(fut.exception()))
+                self.replaced.set_result(None)
+                return
+            self.log.warning("Reconnect failed, retrying in {}s: {}".format(delay, fut.exception()))
+            self.loop.call_later(delay, self.reconnect, retries-1, delay*2)
+
+        self.log.info("Reconnecting to {}:{} for listener port {}".format(*self.peername[:2], self.listen_port))
+        task = self.loop.create_task(
+            create_client(self.host, self.port, *self.peername[:2], mode=self.mode, loop=self.loop,
+                          batch_window=self.batch_window, listen_port=self.listen_port,
+                          tunnel=self.tunnel, congestion=self.congestion, ssl=self.ssl,
+                          server_hostname=self.server_hostname, response_window=self.response_window)
+        )
+        task.add_done_callback(reconnected)
+
     def connection_made(self, transport):
         """
         Established a connection to the Oblique server.
         :param transport:
         :return:
         """
-        self.transport = transport
-        asyncio.ensure_future(self.heartbeat(), loop=self.loop)
+        self.set_transport(transport)
+        self.peername = transport.get_extra_info("peername")
+        ssl_object = transport.get_extra_info("ssl_object")
+        if ssl_object is not None:
+            self.server_hostname = ssl_object.server_hostname
+            self.log.info("TLS {} established ({})".format(
+                ssl_object.version(), "resumed" if ssl_object.session_reused else "full handshake"))
         info = "Forwarding to {}:{}".format(self.host, self.port)
-        self.transport.write(compose(Command.init, 0, struct.pack(">L", self.mode) + info.encode()))
+        self.transport.write(
+            compose(Command.init, 0, struct.pack(">LH", self.mode, self.listen_port) + info.encode())
+        )
+        self.spawn(self.heartbeat())
+
+    def connection_lost(self, exc):
+        """
+        The connection to the Oblique server closed. Stops the heartbeat and any repeater connections still opening,
+        and closes the established ones, e.g. when a drain timed out before their sessions finished.
+        :param exc: exception, or None on a clean close
+        :return: None
+        """
+        self.log.warning("Connection to server lost.")
+        self.cancel_tasks()
+        self.buffers.clear()
+        self.eofs.clear()
+        for session in list(self.sessions.values()):
+            session.close()
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+    async def wait_closed(self) -> None:
+        """
+        Wait until the connection to the Oblique server is closed. If the server was drained, the wait continues
+        with the connection that replaced this one, so a client keeps running across server restarts.
+        :return: None
+        """
+        client = self
+        while client is not None:
+            await asyncio.shield(client.closed)
+            if client.replaced is None:
+                return
+            client = await asyncio.shield(client.replaced)
 
     def data_received(self, data: bytes):
         try:
-            for(cmd, sid, data) in parse(data):
+            for(cmd, sid, data) in self.parse_stream(data):
                 if cmd == Command.init:
-                    msg = data[4:]
+                    self.listen_port = struct.unpack(">LH", data[:INIT_LEN])[1]
+                    msg = data[INIT_LEN:]
                     if msg:
-                        self.log.info("INIT Message: {}".format(msg.decode()))
+                        self.log.info("INIT Message: {} (port {})".format(msg.decode(), self.listen_port))
+                    ssl_object = self.transport.get_extra_info("ssl_object")
+                    if ssl_object is not None:
+                        enable_resumption(self.ssl).store(ssl_object)
+
+                if cmd == Command.drain:
+                    self.log.warning("Server draining.")
+                    if self.replaced is not None:
+                        continue
+                    self.replaced = self.loop.create_future()
+                    self.loop.call_later(random.uniform(0, RECONNECT_JITTER), self.reconnect)
 
                 if cmd == Command.dead:
-                    self.log.warning("Session {:08x} dead.".format(sid))
-                    sess = self.get_session(sid)
-                    if sess is not None:
-                        sess.close()
+                    self.session_dead(sid)
+
+                if cmd == Command.dead_batch:
+                    for dead_sid in parse_batch(data):
+                        self.session_dead(dead_sid)
 
                 if cmd == Command.open:
-                    if self.mode == Mode.tcp:
-                        def tcp_open(conn):
-                            if conn.exception() is not None:
-                                with suppress(KeyError):
-                                    del self.buffers[sid]
-                                self.del_session(sid)
-                                self.transport.write(compose(Command.dead, sid, None))
-                        fut = asyncio.ensure_future(
-                            self.loop.create_connection(partial(RepeaterTCP, sid, self), self.host, self.port)
-                        )
-                        fut.add_done_callback(tcp_open)
+                    self.session_open(sid, data)
+
+                if cmd == Command.open_batch:
+                    for open_sid in parse_batch(data):
+                        self.session_open(open_sid)
 
                 if cmd == Command.data:
                     self.try_send(sid, data)
+
+                if cmd == Command.eof:
+                    self.log.info("Session {:08x} EOF.".format(sid))
+                    if sid not in self.sessions and sid not in self.opening:
+                        # The repeater is already gone (failed to connect, or reset by the destination)
+                        continue
+                    self.eofs.add(sid)
+                    self.try_send(sid)
         except ValueError as e:
             print(e)
             self.transport.close()
             return
 
 
-def create_client(dest_host: str, dest_port: int,
-                  server_host: str, server_port: int=8000,
-                  mode: Mode=Mode.tcp,
-                  loop: asyncio.AbstractEventLoop=None):
-    loop = loop or asyncio.get_event_loop()
-    return loop.create_connection(partial(Client, dest_host, dest_port, mode, loop), server_host, server_port)
+async def create_client(dest_host: str, dest_port: int,
+                        server_host: str, server_port: int=8000,
+                        mode: Mode=Mode.tcp,
+                        loop: asyncio.AbstractEventLoop=None,
+                        batch_window: float=0.002,
+                        listen_port: int=0,
+                        tunnel: Tunnel=Tunnel.tcp,
+                        congestion: Callable[[], CongestionControl]=None,
+                        ssl: SSLContext=None,
+                        server_hostname: str=None,
+                        response_window: float=0.1):
+    """
+    Connect to an Oblique server and forward its listener's sessions to dest_host:dest_port
+
+    :param dest_host: destination host for repeaters
+    :param dest_port: destination port for repeaters
+    :param server_host: Oblique server host
+    :param server_port: Oblique server port
+    :param mode: listener mode
+    :param loop: asyncio event loop
+    :param batch_window: seconds to aggregate open/dead control packets into batches
+    :param listen_port: listener port to ask the server for (0 for any)
+    :param tunnel: transport for the Client-to-Server connection
+    :param congestion: congestion controller factory for UDP tunnels
+    :param ssl: client-side SSLContext to run the tunnel over TLS. Sessions are cached on the context and resumed
+                when reconnecting to the same server process.
+    :param server_hostname: name to verify the server certificate against (defaults to server_host)
+    :param response_window: seconds a repeater that received the endpoint's first data with the open packet waits
+                            for the destination's first response, to send it along with the acknowledgement
+    :return: the transport and Client protocol
+    """
+    loop = loop or asyncio.get_running_loop()
+    factory = partial(Client, dest_host, dest_port, mode, loop, batch_window, listen_port, tunnel, congestion, ssl,
+                      response_window)
+    if tunnel == Tunnel.udp:
+        if ssl is not None:
+            raise ValueError("TLS requires a TCP tunnel")
+        return await open_tunnel(factory, server_host, server_port, loop=loop, congestion=congestion)
+    if ssl is not None:
+        enable_resumption(ssl)
+        return await loop.create_connection(factory, server_host, server_port, ssl=ssl,
+                                            server_hostname=server_hostname)
+    return await loop.create_connection(factory, server_host, server_port)
@@ -6,7 +6,7 @@ import struct
 Oblique command definitions, parsing, and handling
 """
 
-__all__ = ["Command", "Mode", "compose", "parse"]
+__all__ = ["Command", "Mode", "Tunnel", "compose", "compose_batch", "parse", "parse_batch", "parse_partial"]
 
 MAGIC_HEADER = 0xBACCAA73
 HEADER_LEN = sum([
@@ -16,6 +16,12 @@ HEADER_LEN = sum([
     4,  # length
     # arbitrary data
 ])
+MAX_LENGTH = 1 << 20    # Largest data length accepted from a stream. Senders forward single reads (at most 256 KiB).
+INIT_LEN = sum([
+    4,  # Mode
+    2,  # Listener port (requested by the client, 0 for any. The bound port in the server's reply)
+    # informational message
+])
 
 
 class Mode(enum.IntEnum):
@@ -28,11 +34,26 @@ class Mode(enum.IntEnum):
     udp = 2
 
 
+class Tunnel(enum.IntEnum):
+    """
+    Transport carrying the Client-to-Server connection
+    """
+    tcp = 1
+    udp = 2
+
+
 class Command(enum.IntEnum):
     init = 0x01     # Client initialization packet sent to the server
-    open = 0x02     # Server packet sent to the client to open a connection
+    open = 0x02     # Open a connection (server), or acknowledge it (client). May carry the session's first data
     data = 0x03     # A data packet containing the data to forward
     dead = 0x04     # A connection died
+    open_batch = 0x05   # Several open packets, the session IDs are packed in the data
+    dead_batch = 0x06   # Several dead packets, the session IDs are packed in the data
+    eof = 0x07      # A connection finished sending, but may still receive
+    drain = 0x08    # Server packet telling the client to reconnect, no new sessions will be opened on this connection
+    seg = 0x10      # Datagram tunnel: a sequenced packet for the stream of the session ID
+    ack = 0x11      # Datagram tunnel: cumulative and selective acknowledgement for the stream of the session ID
+    reset = 0x12    # Datagram tunnel: the tunnel was closed
     beat = 0xAA
     invalid = 0xF0  # The data received was invalid
 
@@ -43,6 +64,13 @@ class Command(enum.IntEnum):
             Command.open,
             Command.data,
             Command.dead,
+            Command.open_batch,
+            Command.dead_batch,
+            Command.eof,
+            Command.drain,
+            Command.seg,
+            Command.ack,
+            Command.reset,
             Command.beat,
             Command.invalid,
         }
@@ -61,6 +89,31 @@ def compose(command: Command, session_id: int, data: Union[bytes, None]):
     return struct.pack(">LBLL", MAGIC_HEADER, command, session_id, len(data)) + data
 
 
+def compose_batch(command: Command, session_ids: List[int]):
+    """
+    Compose an oblique command packet for several sessions at once. A single session ID is sent as the plain
+    command so peers only see batches when there is something to batch.
+
+    :param command: Command.open or Command.dead
+    :param session_ids: the session IDs the command applies to
+    :return: bytes
+    """
+    if len(session_ids) == 1:
+        return compose(command, session_ids[0], None)
+    batch = {Command.open: Command.open_batch, Command.dead: Command.dead_batch}[command]
+    return compose(batch, 0, struct.pack(">{}L".format(len(session_ids)), *session_ids))
+
+
+def parse_batch(data: bytes) -> Tuple[int, ...]:
+    """
+    Unpack the session IDs carried by a batch command
+
+    :param data: the data of an open_batch or dead_batch packet
+    :return: the session IDs
+    """
+    return struct.unpack(">{}L".format(len(data) // 4), data)
+
+
 def parse_single(data: bytes) -> Tuple[int, int, bytes, bytes]:
     """
     Parse the input data and return the first received command, the associated session ID, and additional data.
@@ -87,9 +140,21 @@ def parse_single(data: bytes) -> Tuple[int, int, bytes, bytes]:
         raise ValueError("Invalid command")
 
     if cmd == Command.init:
-        if length < 4:
+        if length < INIT_LEN:
             raise ValueError("Invalid Init Length")
 
+    if cmd in (Command.open_batch, Command.dead_batch):
+        if length % 4 != 0:
+            raise ValueError("Invalid Batch Length")
+
+    if cmd == Command.seg:
+        if length < 4 + HEADER_LEN:
+            raise ValueError("Invalid Segment Length")
+
+    if cmd == Command.ack:
+        if length < 4 or (length - 4) % 8 != 0:
+            raise ValueError("Invalid Ack Length")
+
     return cmd, sid, data[HEADER_LEN:HEADER_LEN+length], data[HEADER_LEN+length:]
 
 
@@ -98,3 +163,28 @@ def parse(data: bytes) -> Tuple[int, int, bytes]:
     while extra != b"":
         cmd, sid, data, extra = parse_single(extra)
         yield cmd, sid, data
+
+
+def parse_partial(data: Union[bytes, bytearray]) -> Tuple[List[Tuple[int, int, bytes]], int]:
+    """
+    Parse every complete command at the start of a stream. Stream transports may split a command across several
+    reads, so an incomplete trailing command is left to be completed by the next read.
+
+    :param data: raw data to parse
+    :return: the parsed commands, and the number of bytes they took up
+    """
+    commands = []
+    offset = 0
+    while len(data) - offset >= HEADER_LEN:
+        (magic_header, length) = struct.unpack_from(">L5xL", data, offset)
+        if magic_header != MAGIC_HEADER:
+            raise ValueError("Invalid header")
+        if length > MAX_LENGTH:
+            raise ValueError("Invalid length ({}, but the maximum is {})".format(length, MAX_LENGTH))
+        end = offset + HEADER_LEN + length
+        if len(data) < end:
+            break
+        cmd, sid, payload, _ = parse_single(bytes(memoryview(data)[offset:end]))
+        commands.append((cmd, sid, payload))
+        offset = end
+    return commands, offset
@@ -0,0 +1,101 @@
+from abc import ABC, abstractmethod
+
+"""
+Congestion control for the datagram tunnel. Windows are counted in segments.
+"""
+
+__all__ = ["CongestionControl", "NewReno", "FixedWindow"]
+
+
+class CongestionControl(ABC):
+    """
+    Base congestion controller. The datagram tunnel never has more than `cwnd` unacknowledged segments in flight.
+    """
+    cwnd = 10
+
+    @abstractmethod
+    def on_ack(self, count: int, rtt: float) -> None:
+        """
+        Segments were acknowledged
+
+        :param count: number of newly acknowledged segments
+        :param rtt: round trip time sample in seconds (None if only retransmitted segments were acknowledged)
+        :return: None
+        """
+
+    @abstractmethod
+    def on_loss(self, sent: float, now: float) -> None:
+        """
+        A segment was detected lost through selective acknowledgements
+
+        :param sent: time the lost segment was last sent
+        :param now: current time
+        :return: None
+        """
+
+    @abstractmethod
+    def on_timeout(self, now: float) -> None:
+        """
+        The retransmission timer expired
+
+        :param now: current time
+        :return: None
+        """
+
+
+class NewReno(CongestionControl):
+    """
+    Slow start and additive increase, halving the window at most once per round trip on loss.
+    """
+
+    def __init__(self, initial: int=10, minimum: int=2, maximum: int=10000):
+        """
+        :param initial: initial window
+        :param minimum: window after a retransmission timeout
+        :param maximum: window ceiling
+        """
+        self.cwnd = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.ssthresh = float(maximum)
+        self.recovery = float("-inf")
+
+    def on_ack(self, count: int, rtt: float) -> None:
+        if self.cwnd < self.ssthresh:
+            self.cwnd += count
+        else:
+            self.cwnd += count / self.cwnd
+        self.cwnd = min(self.cwnd, self.maximum)
+
+    def on_loss(self, sent: float, now: float) -> None:
+        if sent <= self.recovery:
+            return
+        self.ssthresh = max(self.cwnd / 2, self.minimum)
+        self.cwnd = self.ssthresh
+        self.recovery = now
+
+    def on_timeout(self, now: float) -> None:
+        self.ssthresh = max(self.cwnd / 2, self.minimum)
+        self.cwnd = self.minimum
+        self.recovery = now
+
+
+class FixedWindow(CongestionControl):
+    """
+    A constant window, for links with known capacity.
+    """
+
+    def __init__(self, window: int=64):
+        """
+        :param window: number of segments allowed in flight
+        """
+        self.cwnd = window
+
+    def on_ack(self, count: int, rtt: float) -> None:
+        pass
+
+    def on_loss(self, sent: float, now: float) -> None:
+        pass
+
+    def on_timeout(self, now: float) -> None:
+        pass
@@ -0,0 +1,576 @@
+import asyncio
+import struct
+from collections import OrderedDict, deque
+from functools import partial
+from typing import Callable
+
+from oblique.bases import BaseLoggable
+from oblique.commands import Command, HEADER_LEN, MAGIC_HEADER, compose, parse, parse_batch
+from oblique.congestion import CongestionControl, NewReno
+
+"""
+Datagram (UDP) tunnel transport.
+
+Every oblique packet written to the tunnel is sequenced on the stream of its session ID and carried in a seg packet.
+The receiver acknowledges each stream cumulatively and selectively, and delivers every stream in order on its own, so
+a lost datagram only stalls the sessions whose packets it carried. Batched open/dead packets are split per session so
+they stay ordered with the session's data.
+"""
+
+__all__ = ["DatagramTunnel", "TunnelServerUDP", "TunnelClientUDP", "open_tunnel", "serve_tunnel"]
+
+DATAGRAM_SIZE = 1200                            # Stay below the path MTU of tunnelled/cellular links
+MAX_DATA = DATAGRAM_SIZE - 2 * HEADER_LEN - 4   # Largest data payload fitting in one segment
+MAX_SACK = 16           # Selective acknowledgement blocks per ack packet
+DUP_THRESH = 3          # Segments acknowledged past a missing one before it is retransmitted
+MAX_RETRIES = 10        # Retransmissions before the tunnel is considered dead
+MIN_RTO = 0.2
+MAX_RTO = 10.0
+INITIAL_RTO = 1.0
+TICK = 0.05             # Retransmission timer granularity while segments are in flight
+IDLE_TICK = 1.0
+IDLE_TIMEOUT = 90.0     # Clients send a heartbeat every 30 seconds
+TOMBSTONE_TTL = 120.0   # How long segments for a dead session are still recognized as duplicates
+MAX_FINISHED = 65536    # Dead sessions remembered after their tombstone expired, so late segments are ignored
+RECV_WINDOW = 4096      # Segments buffered past the next expected one on a stream
+BATCHES = {Command.open_batch: Command.open, Command.dead_batch: Command.dead}
+
+
+class Segment(object):
+    __slots__ = ("stream", "seq", "frame", "sent", "retries", "fast")
+
+    def __init__(self, stream: int, seq: int, frame: bytes):
+        self.stream = stream
+        self.seq = seq
+        self.frame = frame
+        self.sent = None
+        self.retries = 0
+        self.fast = False
+
+
+class SendStream(object):
+    def __init__(self):
+        self.next_seq = 0
+        self.queued = 0
+        self.unacked = OrderedDict()
+        self.finished = False
+
+
+class RecvStream(object):
+    def __init__(self, created: float):
+        self.expected = 0
+        self.buffer = dict()
+        self.expires = None
+        self.created = created
+
+
+class DatagramTunnel(BaseLoggable):
+    """
+    Transport for the Client-to-Server connection over a datagram endpoint. Implements the parts of asyncio.Transport
+    used by the Server and Client protocols.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, sendto: Callable[[bytes], None], peername, sockname,
+                 congestion: CongestionControl, on_close: Callable[["DatagramTunnel"], None]=None):
+        """
+        :param loop: asyncio event loop
+        :param sendto: sends a single datagram to the peer
+        :param peername: the peer's address
+        :param sockname: the local address
+        :param congestion: the congestion controller for this tunnel
+        :param on_close: called once the tunnel is closed
+        """
+        self.loop = loop
+        self.sendto = sendto
+        self.extra = {"peername": peername, "sockname": sockname}
+        self.cc = congestion
+        self.on_close = on_close
+        self.protocol = None
+        self.send_streams = dict()
+        self.recv_streams = dict()
+        self.finished = OrderedDict()
+        self.queue = deque()
+        self.resend = OrderedDict()
+        self.acks = set()
+        self.inflight = 0
+        self.srtt = None
+        self.rttvar = None
+        self.rto = INITIAL_RTO
+        self.closing = False
+        self.closed = False
+        self.flush_handle = None
+        self.last_received = loop.time()
+        self.timer = loop.call_later(IDLE_TICK, self.tick)
+
+    def set_protocol(self, protocol: asyncio.Protocol) -> None:
+        self.protocol = protocol
+        protocol.connection_made(self)
+
+    def get_protocol(self) -> asyncio.Protocol:
+        return self.protocol
+
+    def get_extra_info(self, name: str, default=None):
+        return self.extra.get(name, default)
+
+    def is_closing(self) -> bool:
+        return self.closing
+
+    def can_write_eof(self) -> bool:
+        return False
+
+    def write(self, data: bytes) -> None:
+        """
+        Sequence every packet in `data` on its session's stream and send as much as the congestion window allows.
+
+        :param data: one or more composed oblique packets
+        :return: None
+        """
+        if self.closing:
+            return
+        for (cmd, sid, payload) in parse(data):
+            if cmd in BATCHES:
+                for batch_sid in parse_batch(payload):
+                    self.enqueue(batch_sid, BATCHES[cmd], compose(BATCHES[cmd], batch_sid, None))
+            elif cmd in (Command.data, Command.open) and len(payload) > MAX_DATA:
+                # Early data on an open that doesn't fit one datagram continues as data packets
+                self.enqueue(sid, cmd, compose(cmd, sid, payload[:MAX_DATA]))
+                for i in range(MAX_DATA, len(payload), MAX_DATA):
+                    self.enqueue(sid, Command.data, compose(Command.data, sid, payload[i:i+MAX_DATA]))
+            else:
+                self.enqueue(sid, cmd, compose(cmd, sid, payload))
+        self.schedule_flush()
+
+    def enqueue(self, sid: int, cmd: int, frame: bytes) -> None:
+        stream = self.send_streams.get(sid)
+        if stream is None:
+            stream = self.send_streams[sid] = SendStream()
+        self.queue.append(Segment(sid, stream.next_seq, frame))
+        stream.next_seq += 1
+        stream.queued += 1
+        if cmd == Command.dead and sid != 0:
+            stream.finished = True
+
+    def close(self) -> None:
+        """
+        Close the tunnel once every queued packet has been acknowledged
+        :return: None
+        """
+        if self.closing:
+            return
+        self.closing = True
+        self.schedule_flush()
+
+    def abort(self, exc: Exception=None) -> None:
+        """
+        Close the tunnel immediately and tell the peer
+
+        :param exc: exception passed to the protocol's connection_lost
+        :return: None
+        """
+        if self.closed:
+            return
+        self.closing = True
+        self.closed = True
+        self.timer.cancel()
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+        try:
+            self.sendto(compose(Command.reset, 0, None))
+        except OSError:
+            pass
+        self.send_streams.clear()
+        self.recv_streams.clear()
+        self.queue.clear()
+        self.resend.clear()
+        if self.on_close is not None:
+            self.on_close(self)
+        self.loop.call_soon(self.protocol.connection_lost, exc)
+
+    def schedule_flush(self) -> None:
+        if self.flush_handle is None and not self.closed:
+            self.flush_handle = self.loop.call_soon(self.flush)
+
+    def flush(self) -> None:
+        """
+        Send pending acks, retransmissions and new segments, packing as many as fit in each datagram
+        :return: None
+        """
+        self.flush_handle = None
+        now = self.loop.time()
+        idle = not self.inflight
+        packets = [self.compose_ack(sid) for sid in self.acks if sid in self.recv_streams]
+        self.acks.clear()
+
+        for seg in self.resend.values():
+            stream = self.send_streams.get(seg.stream)
+            if stream is None or seg.seq not in stream.unacked:
+                continue
+            seg.retries += 1
+            if seg.retries > MAX_RETRIES:
+                self.log.error("Segment {:08x}:{} lost {} times".format(seg.stream, seg.seq, MAX_RETRIES))
+                self.abort(TimeoutError("Tunnel peer unreachable"))
+                return
+            packets.append(self.compose_segment(seg, now))
+        self.resend.clear()
+
+        while self.queue and self.inflight < self.cc.cwnd:
+            seg = self.queue.popleft()
+            stream = self.send_streams[seg.stream]
+            stream.queued -= 1
+            stream.unacked[seg.seq] = seg
+            self.inflight += 1
+            packets.append(self.compose_segment(seg, now))
+        if idle and self.inflight:
+            # Leave the idle interval so a loss is detected after rto, not up to IDLE_TICK later
+            self.timer.cancel()
+            self.timer = self.loop.call_later(min(TICK, self.rto), self.tick)
+
+        datagram = []
+        size = 0
+        for pkt in packets:
+            if datagram and size + len(pkt) > DATAGRAM_SIZE:
+                self.sendto(b"".join(datagram))
+                datagram = []
+                size = 0
+            datagram.append(pkt)
+            size += len(pkt)
+        if datagram:
+            self.sendto(b"".join(datagram))
+
+        if self.closing and not self.queue and not self.inflight:
+            self.abort()
+
+    @staticmethod
+    def compose_segment(seg: Segment, now: float) -> bytes:
+        seg.sent = now
+        return compose(Command.seg, seg.stream, struct.pack(">L", seg.seq) + seg.frame)
+
+    def compose_ack(self, sid: int) -> bytes:
+        """
+        Acknowledge everything received on a stream: the next expected sequence number followed by up to MAX_SACK
+        [start, end) blocks of segments buffered past a gap.
+
+        :param sid: stream (session) ID
+        :return: the ack packet
+        """
+        stream = self.recv_streams[sid]
+        blocks = []
+        for seq in sorted(stream.buffer):
+            if blocks and blocks[-1][1] == seq:
+                blocks[-1][1] = seq + 1
+            elif len(blocks) < MAX_SACK:
+                blocks.append([seq, seq + 1])
+            else:
+                break
+        sack = b"".join(struct.pack(">LL", start, end) for (start, end) in blocks)
+        return compose(Command.ack, sid, struct.pack(">L", stream.expected) + sack)
+
+    def datagram_received(self, data: bytes) -> None:
+        """
+        A datagram from the peer
+
+        :param data: one or more packets
+        :return: None
+        """
+        if self.closed:
+            return
+        self.last_received = self.loop.time()
+        try:
+            packets = list(parse(data))
+        except ValueError as e:
+            self.log.warning("Dropping datagram from {}:{}: {}".format(*self.extra["peername"][:2], e))
+            return
+
+        for (cmd, sid, payload) in packets:
+            if self.closed:
+                return
+            if cmd == Command.seg:
+                self.segment_received(sid, payload)
+            elif cmd == Command.ack:
+                self.ack_received(sid, payload)
+            elif cmd == Command.reset:
+                self.abort(ConnectionResetError("Tunnel reset by peer"))
+        self.schedule_flush()
+
+    def segment_received(self, sid: int, payload: bytes) -> None:
+        """
+        Buffer a segment and deliver the stream's packets that are now in order. Segments may arrive before the
+        stream's first one, so a lost open is recovered from the selective acks like any other gap; at most
+        RECV_WINDOW segments ahead are buffered. A dead packet ends the stream; later segments for it are
+        acknowledged and dropped, and ignored once the tombstone has expired.
+
+        :param sid: stream (session) ID
+        :param payload: sequence number and packet
+        :return: None
+        """
+        seq = struct.unpack(">L", payload[:4])[0]
+        stream = self.recv_streams.get(sid)
+        if stream is None:
+            if sid in self.finished:
+                # A late retransmission for a session whose tombstone expired
+                return
+            stream = self.recv_streams[sid] = RecvStream(self.loop.time())
+        self.acks.add(sid)
+        if stream.expires is not None:
+            stream.expected = max(stream.expected, seq + 1)
+            return
+        if seq < stream.expected or seq in stream.buffer or seq >= stream.expected + RECV_WINDOW:
+            return
+
+        stream.buffer[seq] = payload[4:]
+        frames = []
+        while stream.expected in stream.buffer:
+            frame = stream.buffer.pop(stream.expected)
+            stream.expected += 1
+            frames.append(frame)
+            if sid != 0 and frame[4] == Command.dead:
+                stream.expected = max([stream.expected] + [buffered + 1 for buffered in stream.buffer])
+                stream.buffer.clear()
+                stream.expires = self.loop.time() + TOMBSTONE_TTL
+                break
+        if frames:
+            self.protocol.data_received(b"".join(frames))
+
+    def ack_received(self, sid: int, payload: bytes) -> None:
+        """
+        Release acknowledged segments, sample the round trip time and retransmit segments that later segments on
+        the same stream have overtaken.
+
+        :param sid: stream (session) ID
+        :param payload: cumulative ack and selective ack blocks
+        :return: None
+        """
+        stream = self.send_streams.get(sid)
+        if stream is None:
+            return
+        now = self.loop.time()
+        cumulative = struct.unpack(">L", payload[:4])[0]
+        blocks = [struct.unpack(">LL", payload[i:i+8]) for i in range(4, len(payload), 8)]
+
+        acked = 0
+        rtt = None
+        for seq in list(stream.unacked):
+            if seq < cumulative or any(start <= seq < end for (start, end) in blocks):
+                seg = stream.unacked.pop(seq)
+                acked += 1
+                if seg.retries == 0:
+                    rtt = now - seg.sent
+
+        if acked:
+            self.inflight -= acked
+            if rtt is not None:
+                self.update_rto(rtt)
+            self.cc.on_ack(acked, rtt)
+
+        if blocks:
+            # Early retransmit (RFC 5827): a short stream with nothing left to send can't produce DUP_THRESH
+            # segments past a hole, so the threshold drops to what it actually has in flight
+            threshold = DUP_THRESH
+            if not stream.queued:
+                threshold = max(1, min(DUP_THRESH, len(stream.unacked) + acked - 1))
+            highest = max(end for (_, end) in blocks) - 1
+            for seg in stream.unacked.values():
+                if seg.seq + threshold > highest:
+                    break
+                if not seg.fast:
+                    seg.fast = True
+                    self.cc.on_loss(seg.sent, now)
+                    self.resend[(seg.stream, seg.seq)] = seg
+
+        if stream.finished and not stream.unacked and not stream.queued:
+            del self.send_streams[sid]
+
+    def update_rto(self, rtt: float) -> None:
+        """
+        RFC 6298 retransmission timeout estimate
+
+        :param rtt: round trip time sample
+        :return: None
+        """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_RTO), MAX_RTO)
+
+    def tick(self) -> None:
+        """
+        Retransmission timer. Also expires dead streams and idle tunnels.
+        :return: None
+        """
+        now = self.loop.time()
+        if now - self.last_received > IDLE_TIMEOUT:
+            self.log.warning("Tunnel to {}:{} idle".format(*self.extra["peername"][:2]))
+            self.abort(TimeoutError("Tunnel idle"))
+            return
+
+        timed_out = False
+        for stream in self.send_streams.values():
+            for seg in stream.unacked.values():
+                if now - seg.sent >= self.rto:
+                    self.resend[(seg.stream, seg.seq)] = seg
+                    timed_out = True
+        if timed_out:
+            self.rto = min(self.rto * 2, MAX_RTO)
+            self.cc.on_timeout(now)
+            self.schedule_flush()
+
+        for (sid, stream) in list(self.recv_streams.items()):
+            if stream.expires is not None and stream.expires < now:
+                del self.recv_streams[sid]
+                self.finished[sid] = None
+                if len(self.finished) > MAX_FINISHED:
+                    self.finished.popitem(last=False)
+            elif stream.expected == 0 and stream.created + TOMBSTONE_TTL < now:
+                # Segments for a stream whose first segment never arrived
+                del self.recv_streams[sid]
+
+        self.timer = self.loop.call_later(TICK if self.inflight else IDLE_TICK, self.tick)
+
+
+class TunnelServerUDP(asyncio.DatagramProtocol, BaseLoggable):
+    """
+    Server side of the datagram tunnel. Demultiplexes datagrams by peer address, creating a tunnel and a protocol
+    instance for every new peer. Mirrors the parts of asyncio.Server used by ServerGroup.
+    """
+
+    def __init__(self, factory: Callable[[], asyncio.Protocol], loop: asyncio.AbstractEventLoop=None,
+                 congestion: Callable[[], CongestionControl]=None):
+        """
+        :param factory: protocol factory, called once per client
+        :param loop: asyncio event loop
+        :param congestion: congestion controller factory, called once per client
+        """
+        self.factory = factory
+        self.loop = loop or asyncio.get_running_loop()
+        self.congestion = congestion or NewReno
+        self.tunnels = dict()
+        self.transport = None
+        self.accepting = True
+        self.closed = self.loop.create_future()
+
+    @property
+    def sockets(self) -> list:
+        return [self.transport.get_extra_info("socket")]
+
+    def connection_made(self, transport: asyncio.DatagramTransport) -> None:
+        self.transport = transport
+
+    def connection_lost(self, exc: Exception) -> None:
+        for tunnel in list(self.tunnels.values()):
+            tunnel.abort(exc)
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        tunnel = self.tunnels.get(addr)
+        if tunnel is None:
+            if not self.accepting or not self.is_init(data):
+                return
+            tunnel = DatagramTunnel(self.loop, partial(self.transport.sendto, addr=addr), addr,
+                                    self.transport.get_extra_info("sockname"), self.congestion(), self.remove)
+            self.tunnels[addr] = tunnel
+            tunnel.set_protocol(self.factory())
+        tunnel.datagram_received(data)
+
+    def error_received(self, exc: Exception) -> None:
+        self.log.warning("Datagram error: {}".format(exc))
+
+    @staticmethod
+    def is_init(data: bytes) -> bool:
+        """
+        Only a client's first segment (the init packet, sequence 0 of stream 0) opens a tunnel. Stray segments from
+        the address of a tunnel that is already gone are ignored.
+
+        :param data: a datagram from an unknown address
+        :return: True if the datagram starts with the init segment
+        """
+        if len(data) < 2 * HEADER_LEN + 4:
+            return False
+        (magic_header, cmd, sid, _, seq) = struct.unpack(">LBLLL", data[:HEADER_LEN + 4])
+        return (magic_header == MAGIC_HEADER and cmd == Command.seg and sid == 0 and seq == 0
+                and data[HEADER_LEN + 8] == Command.init)
+
+    def remove(self, tunnel: DatagramTunnel) -> None:
+        self.tunnels.pop(tunnel.get_extra_info("peername"), None)
+        if not self.accepting and not self.tunnels:
+            self.transport.close()
+
+    def close(self) -> None:
+        """
+        Stop accepting new clients. The socket is closed once the established tunnels are gone.
+        :return: None
+        """
+        self.accepting = False
+        if not self.tunnels:
+            self.transport.close()
+
+    async def wait_closed(self):
+        await asyncio.shield(self.closed)
+
+
+class TunnelClientUDP(asyncio.DatagramProtocol, BaseLoggable):
+    """
+    Client side of the datagram tunnel.
+    """
+
+    def __init__(self, factory: Callable[[], asyncio.Protocol], loop: asyncio.AbstractEventLoop=None,
+                 congestion: Callable[[], CongestionControl]=None):
+        """
+        :param factory: protocol factory
+        :param loop: asyncio event loop
+        :param congestion: congestion controller factory
+        """
+        self.factory = factory
+        self.loop = loop or asyncio.get_running_loop()
+        self.congestion = congestion or NewReno
+        self.transport = None
+        self.tunnel = None
+
+    def connection_made(self, transport: asyncio.DatagramTransport) -> None:
+        self.transport = transport
+        self.tunnel = DatagramTunnel(self.loop, transport.sendto, transport.get_extra_info("peername"),
+                                     transport.get_extra_info("sockname"), self.congestion(), self.remove)
+        self.tunnel.set_protocol(self.factory())
+
+    def connection_lost(self, exc: Exception) -> None:
+        self.tunnel.abort(exc)
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        self.tunnel.datagram_received(data)
+
+    def error_received(self, exc: Exception) -> None:
+        self.log.warning("Datagram error: {}".format(exc))
+
+    def remove(self, tunnel: DatagramTunnel) -> None:
+        self.transport.close()
+
+
+async def open_tunnel(factory: Callable[[], asyncio.Protocol], host: str, port: int,
+                      loop: asyncio.AbstractEventLoop=None, congestion: Callable[[], CongestionControl]=None):
+    """
+    Datagram counterpart of loop.create_connection
+
+    :return: the tunnel and the protocol instance
+    """
+    loop = loop or asyncio.get_running_loop()
+    _, endpoint = await loop.create_datagram_endpoint(
+        partial(TunnelClientUDP, factory, loop, congestion), remote_addr=(host, port)
+    )
+    return endpoint.tunnel, endpoint.tunnel.get_protocol()
+
+
+async def serve_tunnel(factory: Callable[[], asyncio.Protocol], host: str, port: int,
+                       loop: asyncio.AbstractEventLoop=None, congestion: Callable[[], CongestionControl]=None):
+    """
+    Datagram counterpart of loop.create_server
+
+    :return: the TunnelServerUDP
+    """
+    loop = loop or asyncio.get_running_loop()
+    _, server = await loop.create_datagram_endpoint(
+        partial(TunnelServerUDP, factory, loop, congestion), local_addr=(host or "0.0.0.0", port)
+    )
+    return server
@@ -0,0 +1,60 @@
+import array
+import json
+import socket
+from typing import List, Tuple
+
+"""
+Listening socket handoff between oblique processes over a Unix socket (SCM_RIGHTS). Unix only.
+"""
+
+__all__ = ["send_sockets", "receive_sockets"]
+
+MAX_SOCKETS = 256
+MAX_META = 65536
+
+
+def send_sockets(conn: socket.socket, entries: List[Tuple[str, int, socket.socket]]) -> None:
+    """
+    Send listening sockets to another process. The descriptors are duplicated by the kernel, so the sender may close
+    its own copies afterwards without affecting the receiver.
+
+    :param conn: a connected AF_UNIX stream socket
+    :param entries: (kind, port, socket) tuples. kind is "control" or "listener"
+    :return: None
+    """
+    meta = json.dumps([[kind, port] for (kind, port, _) in entries]).encode()
+    fds = array.array("i", [sock.fileno() for (_, _, sock) in entries])
+    conn.sendmsg([meta], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+
+
+def receive_sockets(path: str, timeout: float=5.0) -> List[Tuple[str, int, socket.socket]]:
+    """
+    Connect to a running oblique process and take over its listening sockets
+
+    :param path: path of the Unix socket the running process is serving the handoff on
+    :param timeout: seconds to wait for the running process
+    :return: (kind, port, socket) tuples
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(timeout)
+    try:
+        conn.connect(path)
+        fds = array.array("i")
+        meta, ancdata, flags, _ = conn.recvmsg(MAX_META, socket.CMSG_SPACE(MAX_SOCKETS * fds.itemsize))
+    finally:
+        conn.close()
+
+    for (level, kind, data) in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+
+    if flags & (socket.MSG_TRUNC | socket.MSG_CTRUNC):
+        for fd in fds:
+            socket.socket(fileno=fd).close()
+        raise ValueError("Socket handoff truncated")
+
+    entries = json.loads(meta.decode())
+    if len(entries) != len(fds):
+        raise ValueError("Socket handoff mismatch ({} sockets, but expected {})".format(len(fds), len(entries)))
+
+    return [(kind, port, socket.socket(fileno=fd)) for ((kind, port), fd) in zip(entries, fds)]
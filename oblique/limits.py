@@ -0,0 +1,125 @@
+import asyncio
+from typing import Union
+
+"""
+Admission control and rate limiting for oblique listeners
+"""
+
+__all__ = ["Limits", "TokenBucket"]
+
+
+class TokenBucket(object):
+    """
+    A simple token bucket. Tokens refill continuously at `rate` per second up to `capacity`.
+    """
+
+    def __init__(self, rate: float, capacity: float=None, loop: asyncio.AbstractEventLoop=None):
+        """
+        Construct a token bucket that starts full
+
+        :param rate: tokens added per second
+        :param capacity: maximum number of tokens held (defaults to one second worth of tokens)
+        :param loop: asyncio event loop used as the clock
+        """
+        if rate <= 0:
+            raise ValueError("Token bucket rate must be positive")
+        self.loop = loop or asyncio.get_running_loop()
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.stamp = self.loop.time()
+
+    def refill(self) -> None:
+        """
+        Add the tokens accumulated since the last refill
+        :return: None
+        """
+        now = self.loop.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def consume(self, count: float=1) -> bool:
+        """
+        Remove `count` tokens only if they are all available
+
+        :param count: number of tokens required
+        :return: True if the tokens were consumed
+        """
+        self.refill()
+        if self.tokens < count:
+            return False
+        self.tokens -= count
+        return True
+
+    def take(self, count: float) -> float:
+        """
+        Remove `count` tokens unconditionally, going into debt if necessary. Used for byte counts, where a single
+        chunk may be larger than the bucket itself.
+
+        :param count: number of tokens to remove
+        :return: the number of seconds until the bucket is out of debt (0 if it never was)
+        """
+        self.refill()
+        self.tokens -= count
+        return self.delay(0)
+
+    def delay(self, count: float=1) -> float:
+        """
+        :param count: number of tokens required
+        :return: the number of seconds until `count` tokens will be available
+        """
+        self.refill()
+        if self.tokens >= count:
+            return 0.0
+        return (count - self.tokens) / self.rate
+
+
+class Limits(object):
+    """
+    Per-listener admission and bandwidth limits. Every limit defaults to None (unbounded). Each Oblique client gets
+    its own Listener and therefore its own set of buckets, so one client cannot exhaust another's allowance.
+    """
+
+    def __init__(self,
+                 max_sessions: Union[int, None]=None,
+                 max_pending: int=128,
+                 accept_rate: Union[float, None]=None,
+                 accept_burst: Union[float, None]=None,
+                 session_rate: Union[float, None]=None,
+                 session_burst: Union[float, None]=None,
+                 client_rate: Union[float, None]=None,
+                 client_burst: Union[float, None]=None):
+        """
+        :param max_sessions: maximum number of concurrent sessions per listener
+        :param max_pending: maximum number of accepted connections waiting for admission. Beyond this, new
+                            connections are closed immediately.
+        :param accept_rate: sessions admitted per second per listener
+        :param accept_burst: accept bucket size (defaults to accept_rate)
+        :param session_rate: bytes per second each session may send into the tunnel
+        :param session_burst: session bucket size in bytes (defaults to session_rate)
+        :param client_rate: bytes per second all sessions of one client may send into the tunnel
+        :param client_burst: client bucket size in bytes (defaults to client_rate)
+        """
+        self.max_sessions = max_sessions
+        self.max_pending = max_pending
+        self.accept_rate = accept_rate
+        self.accept_burst = accept_burst
+        self.session_rate = session_rate
+        self.session_burst = session_burst
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+
+    def accept_bucket(self, loop: asyncio.AbstractEventLoop=None) -> Union[TokenBucket, None]:
+        if self.accept_rate is None:
+            return None
+        return TokenBucket(self.accept_rate, self.accept_burst, loop=loop)
+
+    def session_bucket(self, loop: asyncio.AbstractEventLoop=None) -> Union[TokenBucket, None]:
+        if self.session_rate is None:
+            return None
+        return TokenBucket(self.session_rate, self.session_burst, loop=loop)
+
+    def client_bucket(self, loop: asyncio.AbstractEventLoop=None) -> Union[TokenBucket, None]:
+        if self.client_rate is None:
+            return None
+        return TokenBucket(self.client_rate, self.client_burst, loop=loop)
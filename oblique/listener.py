@@ -1,4 +1,5 @@
 import asyncio
+from collections import deque
 from oblique.bases import BaseServer, BaseListener
 from oblique.commands import Command, compose
 from oblique.utils import gen_unique_id
@@ -21,7 +22,11 @@ class ListenerTCP(BaseListener, asyncio.Protocol):
         self.transport = None
         self.peername = None
         self.session_id = gen_unique_id()
-        self.server.add_session(self.session_id, self)
+        self.opened = False
+        self.bucket = self.server.limits.session_bucket(self.server.loop)
+        self.throttled = deque()
+        self.throttle_handle = None
+        self.eof_pending = False
 
     def connection_lost(self, exc: Exception) -> None:
         """
@@ -31,33 +36,115 @@ class ListenerTCP(BaseListener, asyncio.Protocol):
         :return: None
         """
         self.log.warning("Session {:08x} disconnected from {}:{}".format(self.session_id, *self.peername))
-        self.server.del_session(self.session_id)
-        self.server.transport.write(compose(Command.dead, self.session_id, None))
+        if self.throttle_handle is not None:
+            self.throttle_handle.cancel()
+            self.throttle_handle = None
+        self.throttled.clear()
+        if self.opened:
+            self.server.del_session(self.session_id)
+            self.server.send_control(Command.dead, self.session_id)
+        self.server.release(self)
         self.transport.close()
 
     def connection_made(self, transport: asyncio.Transport) -> None:
         """
-        A TCP connection was received from an endpoint
+        A TCP connection was received from an endpoint. The server decides whether the session is opened now,
+        queued, or rejected.
 
         :param transport: endpoint transport provided by asyncio
         :return: None
         """
         self.transport = transport
         self.peername = transport.get_extra_info("peername")
-        self.server.transport.write(compose(Command.open, self.session_id, None))
+        self.server.admit(self)
+
+    def open(self) -> None:
+        """
+        The session was admitted. Register it and inform the client.
+        :return: None
+        """
+        self.opened = True
+        self.server.add_session(self.session_id, self)
+        self.server.send_control(Command.open, self.session_id)
         self.log.info("Connection Open: Session {:08x}: {}:{}".format(self.session_id, *self.peername))
 
+    def reject(self) -> None:
+        """
+        The session was refused by admission control. Drop the endpoint without involving the client.
+        :return: None
+        """
+        self.log.warning("Session {:08x} rejected from {}:{}".format(self.session_id, *self.peername))
+        self.transport.abort()
+
     def data_received(self, data: bytes) -> None:
         """
         Data received from a listener. Forward it out the server's connection to the client
-        along with the session ID
+        along with the session ID. If the session's open packet is still queued, the data is sent with it so the
+        client can write it as soon as the repeater connects. If the session or client is over its bandwidth
+        allowance, reading is paused and the frame is held back until the buckets recover.
+
         :param data: data sent by the endpoint protocol
         :return: None
         """
         self.log.debug("Session {:08x} received {} bytes".format(self.session_id, len(data)))
+        delay = 0.0
+        for bucket in (self.bucket, self.server.client_bucket):
+            if bucket is not None:
+                delay = max(delay, bucket.take(len(data)))
+
+        if not self.throttled and delay <= 0 and self.server.take_control(Command.open, self.session_id):
+            self.server.write(compose(Command.open, self.session_id, data))
+            return
+
         pkt = compose(Command.data, self.session_id, data)
+        if self.throttled or delay > 0:
+            self.throttled.append(pkt)
+            if self.throttle_handle is None:
+                self.transport.pause_reading()
+                self.throttle_handle = self.server.loop.call_later(delay, self.flush_throttled)
+            return
+
         self.log.info("Sendng to {}:{}".format(*self.server.transport.get_extra_info("peername")))
-        self.server.transport.write(pkt)
+        self.server.write(pkt)
+
+    def flush_throttled(self) -> None:
+        """
+        Release frames held back by the bandwidth limits and resume reading from the endpoint.
+        :return: None
+        """
+        self.throttle_handle = None
+        while self.throttled:
+            self.server.write(self.throttled.popleft())
+        if self.eof_pending:
+            self.forward_eof()
+        else:
+            self.transport.resume_reading()
+
+    def eof_received(self) -> bool:
+        """
+        The endpoint finished sending. Forward the EOF once any throttled data has gone out, and keep the transport
+        open so the response can still be delivered.
+
+        :return: True to keep the transport half-open
+        """
+        self.log.info("Session {:08x} EOF from {}:{}".format(self.session_id, *self.peername))
+        if not self.opened:
+            return False
+        if self.throttled:
+            self.eof_pending = True
+        else:
+            self.forward_eof()
+        return True
+
+    def forward_eof(self) -> None:
+        """
+        Inform the client that the endpoint will not send any more data
+        :return: None
+        """
+        self.eof_pending = False
+        self.read_closed = True
+        self.server.write(compose(Command.eof, self.session_id, None))
+        self.check_closed()
 
     def send(self, data: bytes) -> None:
         """
@@ -9,31 +9,77 @@ class RepeaterTCP(BaseRepeater, asyncio.Protocol):
         self.session_id = session_id
         self.transport = None
         self.peername = None
+        self.ack_handle = None
         self.log.debug("Created Repeater for session ID {:08x}".format(session_id))
 
     def connection_made(self, transport: asyncio.Transport) -> None:
         """
-        Connection made from the repeater to the destination host/port
+        Connection made from the repeater to the destination host/port. If the endpoint's first data came with the
+        open packet, it is written now and the acknowledgement waits briefly for the destination's response.
 
         :param transport: transport provided by asyncio
         :return:
         """
         self.transport = transport
         self.peername = transport.get_extra_info("peername")
+        if self.session_id not in self.client.opening:
+            self.log.info("Session {:08x} died while connecting".format(self.session_id))
+            transport.abort()
+            return
         self.log.info("Session {:08x} made to {}:{}".format(self.session_id, *self.peername))
         self.client.add_session(self.session_id, self)
-        self.client.transport.write(compose(Command.open, self.session_id, None))
+        if self.client.session_connected(self.session_id):
+            self.ack_handle = self.client.loop.call_later(self.client.response_window, self.acknowledge)
+        else:
+            self.acknowledge()
+
+    def acknowledge(self, data: bytes=None) -> None:
+        """
+        Acknowledge the open to the server
+
+        :param data: the destination's first data, sent along with the acknowledgement
+        :return: None
+        """
+        if self.ack_handle is not None:
+            self.ack_handle.cancel()
+            self.ack_handle = None
+        if data:
+            self.client.write(compose(Command.open, self.session_id, data))
+        else:
+            self.client.send_control(Command.open, self.session_id)
 
     def connection_lost(self, exc):
         self.log.warning("Session {:08x} list to {}:{}".format(self.session_id, *self.peername))
-        self.client.transport.write(compose(Command.dead, self.session_id, None))
+        if self.client.get_session(self.session_id) is not self:
+            return
+        if self.ack_handle is not None:
+            self.acknowledge()
+        self.client.send_control(Command.dead, self.session_id)
         self.client.del_session(self.session_id)
         self.transport.close()
 
     def data_received(self, data):
         self.log.debug("Session {:08x} received {} bytes".format(self.session_id, len(data)))
+        if self.ack_handle is not None or self.client.take_control(Command.open, self.session_id):
+            self.acknowledge(data)
+            return
         pkt = compose(Command.data, self.session_id, data)
-        self.client.transport.write(pkt)
+        self.client.write(pkt)
+
+    def eof_received(self) -> bool:
+        """
+        The destination finished sending. Forward the EOF and keep the transport open so the remaining request data
+        can still be delivered.
+
+        :return: True to keep the transport half-open
+        """
+        self.log.info("Session {:08x} EOF from {}:{}".format(self.session_id, *self.peername))
+        if self.ack_handle is not None:
+            self.acknowledge()
+        self.read_closed = True
+        self.client.write(compose(Command.eof, self.session_id, None))
+        self.check_closed()
+        return True
 
     def send(self, data: bytes) -> None:
         """
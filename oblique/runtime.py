@@ -0,0 +1,67 @@
+import asyncio
+import signal
+from contextlib import suppress
+from typing import Coroutine
+from oblique.log import make_logger
+
+"""
+Event loop setup and the oblique.run() entry point
+"""
+
+__all__ = ["run", "new_event_loop"]
+
+
+def new_event_loop(use_uvloop: bool=True) -> asyncio.AbstractEventLoop:
+    """
+    Create an event loop, using uvloop when it is installed
+
+    :param use_uvloop: set to False to always use the asyncio event loop
+    :return: the new event loop
+    """
+    if use_uvloop:
+        try:
+            import uvloop
+        except ImportError:
+            make_logger().info("Running without uvloop")
+        else:
+            return uvloop.new_event_loop()
+    return asyncio.new_event_loop()
+
+
+async def gather(*coros: Coroutine) -> None:
+    """
+    Run the coroutines in one task group. If any of them fails, or the process receives SIGTERM, the others are
+    cancelled and the group waits for them to finish cleaning up.
+
+    :param coros: coroutines to run
+    :return: None
+    """
+    loop = asyncio.get_running_loop()
+    main = asyncio.current_task()
+    with suppress(NotImplementedError):
+        loop.add_signal_handler(signal.SIGTERM, main.cancel)
+    try:
+        async with asyncio.TaskGroup() as group:
+            for coro in coros:
+                group.create_task(coro)
+    finally:
+        with suppress(NotImplementedError):
+            loop.remove_signal_handler(signal.SIGTERM)
+
+
+def run(*coros: Coroutine, use_uvloop: bool=True, eager_tasks: bool=True, debug: bool=None) -> None:
+    """
+    Run oblique servers and clients until they finish or the process is interrupted (SIGINT/SIGTERM).
+
+    :param coros: coroutines to run concurrently, e.g. one that serves a ServerGroup and one that waits on a Client
+    :param use_uvloop: use uvloop when it is installed
+    :param eager_tasks: start tasks eagerly (Python 3.12+), so per-session work such as connecting a repeater
+                        starts in the same loop iteration instead of the next one
+    :param debug: asyncio debug mode
+    :return: None
+    """
+    with asyncio.Runner(debug=debug, loop_factory=lambda: new_event_loop(use_uvloop)) as runner:
+        if eager_tasks and hasattr(asyncio, "eager_task_factory"):
+            runner.get_loop().set_task_factory(asyncio.eager_task_factory)
+        with suppress(KeyboardInterrupt, asyncio.CancelledError):
+            runner.run(gather(*coros))
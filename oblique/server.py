@@ -1,13 +1,23 @@
 import asyncio
+import os
 import random
+import socket
 import struct
 import sys
 
 from asyncio.transports import Transport, DatagramTransport
+from collections import defaultdict, deque
+from contextlib import suppress
 from functools import partial
+from ssl import SSLContext
+from typing import Callable
 
-from oblique.bases import BaseServer, BaseListener
-from oblique.commands import Command, Mode, parse, compose
+from oblique.bases import BaseServer, BaseListener, BaseLoggable
+from oblique.commands import Command, Mode, Tunnel, INIT_LEN, parse_batch, compose
+from oblique.congestion import CongestionControl
+from oblique.datagram import serve_tunnel
+from oblique.handoff import send_sockets, receive_sockets
+from oblique.limits import Limits
 from oblique.listener import ListenerTCP
 from oblique.log import make_logger
 
@@ -17,18 +27,145 @@ Oblique Server implementation
 Oblique is a TCP protocol that runs over IPv4/IPv6.
 """
 
-__all__ = ["Server", "create_server"]
+__all__ = ["Server", "ServerGroup", "create_server"]
 
 
 class Server(BaseServer):
-    def __init__(self, loop: asyncio.AbstractEventLoop=None):
-        super().__init__(loop)
+    def __init__(self, loop: asyncio.AbstractEventLoop=None, limits: Limits=None, batch_window: float=0.002,
+                 group: "ServerGroup"=None):
+        super().__init__(loop, batch_window)
         self.log.debug("instantiated")
         self.peername = None
-        self.listener = None
+        self.group = group
+        self.listeners = []
+        self.port = None
+        self.draining = False
+        self.limits = limits or Limits()
+        self.pending = deque()
+        self.pending_handle = None
+        self.accept_bucket = self.limits.accept_bucket(self.loop)
+        self.client_bucket = self.limits.client_bucket(self.loop)
+
+    def can_open(self) -> bool:
+        """
+        Check the concurrent session cap and the accept rate. Consumes an accept token on success.
+        :return: True if a new session may be opened now
+        """
+        if self.limits.max_sessions is not None and len(self.sessions) >= self.limits.max_sessions:
+            return False
+        if self.accept_bucket is not None and not self.accept_bucket.consume():
+            return False
+        return True
+
+    def admit(self, listener: ListenerTCP) -> None:
+        """
+        Open the listener's session if the limits allow it, otherwise queue it. If the pending queue is full, the
+        endpoint is rejected.
+
+        :param listener: a freshly accepted listener connection
+        :return: None
+        """
+        if self.draining:
+            listener.reject()
+            return
+        if not self.pending and self.can_open():
+            listener.open()
+            return
+        if len(self.pending) >= self.limits.max_pending:
+            listener.reject()
+            return
+        listener.transport.pause_reading()
+        self.pending.append(listener)
+        self.schedule_pending()
+
+    def release(self, listener: ListenerTCP) -> None:
+        """
+        A listener connection is gone. Drop it from the pending queue and let a waiting endpoint take its place.
+
+        :param listener: the closed listener connection
+        :return: None
+        """
+        with suppress(ValueError):
+            self.pending.remove(listener)
+        self.admit_pending()
+        self.check_drained()
+
+    def admit_pending(self) -> None:
+        """
+        Open as many queued sessions as the limits currently allow.
+        :return: None
+        """
+        self.pending_handle = None
+        if self.draining:
+            return
+        while self.pending and self.can_open():
+            listener = self.pending.popleft()
+            listener.transport.resume_reading()
+            listener.open()
+        self.schedule_pending()
+
+    def schedule_pending(self) -> None:
+        """
+        If sessions are only waiting on the accept rate, retry once a token is available. Sessions waiting on the
+        concurrency cap are admitted from release() instead.
+        :return: None
+        """
+        if not self.pending or self.pending_handle is not None or self.accept_bucket is None:
+            return
+        if self.limits.max_sessions is not None and len(self.sessions) >= self.limits.max_sessions:
+            return
+        self.pending_handle = self.loop.call_later(self.accept_bucket.delay(), self.admit_pending)
+
+    def drain(self) -> None:
+        """
+        Stop accepting endpoint connections and tell the client to reconnect. Endpoints still waiting for admission
+        are rejected. The tunnel is closed once the remaining sessions have finished.
+        :return: None
+        """
+        self.log.info("Draining client {}:{}".format(*self.peername))
+        self.draining = True
+        self.close_listeners()
+        if self.pending_handle is not None:
+            self.pending_handle.cancel()
+            self.pending_handle = None
+        while self.pending:
+            self.pending.popleft().reject()
+        if not self.transport.is_closing():
+            self.write(compose(Command.drain, 0, None))
+        self.check_drained()
+
+    def check_drained(self) -> None:
+        """
+        Close the tunnel if draining and no sessions are left.
+        :return: None
+        """
+        if self.draining and not self.sessions and not self.pending and not self.transport.is_closing():
+            self.log.info("Client {}:{} drained".format(*self.peername))
+            self.flush()
+            self.transport.close()
+
+    def close_listeners(self) -> None:
+        """
+        Stop accepting endpoint connections. Established sessions are not affected.
+        :return: None
+        """
+        for listener in self.listeners:
+            listener.close()
+        self.listeners = []
 
     def connection_lost(self, exc):
-        self.log.error("Connection Lost from client {}:{}".format(*self.transport.get_extra_info("peername")))
+        self.log.error("Connection Lost from client {}:{}".format(*self.peername))
+        self.cancel_tasks()
+        if self.pending_handle is not None:
+            self.pending_handle.cancel()
+            self.pending_handle = None
+        while self.pending:
+            self.pending.popleft().reject()
+        self.close_listeners()
+        for session in list(self.sessions.values()):
+            session.close()
+        if self.group is not None:
+            self.group.discard(self)
 
     def connection_made(self, transport: Transport) -> None:
         """
@@ -39,7 +176,62 @@ class Server(BaseServer):
         """
         self.peername = transport.get_extra_info("peername")
         self.log.info("Client connected from {}:{}".format(*self.peername))
-        self.transport = transport
+        self.set_transport(transport)
+        if self.group is not None:
+            self.group.servers.add(self)
+            if self.group.draining:
+                # Accepted just before the control port was closed
+                self.drain()
+
+    async def create_listener(self, mode: int, port: int, msg: bytes):
+        """
+        Create the TCP listener for this client. A listening socket inherited from a previous process for the
+        requested port is preferred, then binding the requested port, then a random port.
+
+        :param mode: the mode requested by the client
+        :param port: the port requested by the client (0 for any)
+        :param msg: the client's informational message
+        :return: None
+        """
+        factory = partial(ListenerTCP, self)
+        adopted = self.group.adopt(port) if self.group is not None and port else []
+        if adopted:
+            for sock in adopted:
+                self.listeners.append(await self.loop.create_server(factory, sock=sock))
+            self.log.info("Adopted TCP Listener on port {}".format(port))
+        else:
+            candidates = [port] if port else []
+            while not self.listeners:
+                port = candidates.pop() if candidates else random.randint(1025, 65535)
+                try:
+                    self.listeners.append(await self.loop.create_server(factory, host="", port=port))
+                except OSError as e:
+                    self.log.warning("Unable to listen on port {}: {}".format(port, e))
+            self.log.info("Created TCP Listener on port {}".format(port))
+
+        self.port = port
+        if self.transport.is_closing() or self.draining:
+            self.close_listeners()
+            return
+        self.log.info("Client INIT: {}".format(msg.decode()))
+        self.write(
+            compose(Command.init,
+                    0,
+                    struct.pack(">LH", mode, port) + b"Successfully created a listener.")
+        )
+
+    def session_dead(self, session_id: int) -> None:
+        """
+        The client's repeater for a session died. Close the endpoint connection.
+
+        :param session_id: the session ID
+        :return: None
+        """
+        self.log.warning("Session {:08x} dead.".format(session_id))
+        sess = self.get_session(session_id)
+        if sess:
+            sess.close()
+            self.del_session(session_id)
 
     def data_received(self, data: bytes) -> None:
         """
@@ -49,14 +241,25 @@ class Server(BaseServer):
         """
         self.log.debug("{} bytes received".format(len(data)))
         try:
-            for (cmd, sid, data) in parse(data):
+            for (cmd, sid, data) in self.parse_stream(data):
                 if cmd == Command.dead:
-                    self.log.warning("Session {:08x} dead.".format(sid))
-                    sess = self.get_session(sid)
-                    if sess:
-                        sess.close()
-                        self.del_session(sid)
-                    return
+                    self.session_dead(sid)
+
+                if cmd == Command.dead_batch:
+                    for dead_sid in parse_batch(data):
+                        self.session_dead(dead_sid)
+
+                if cmd == Command.open and data:
+                    # The repeater's acknowledgement carries the destination's first response
+                    session = self.get_session(sid)
+                    if session:
+                        session.send(data)
+
+                if cmd == Command.eof:
+                    self.log.info("Session {:08x} EOF.".format(sid))
+                    session = self.get_session(sid)
+                    if session:
+                        session.send_eof()
 
                 if cmd == Command.init:
                     self.log.debug("INIT received from Client {}:{}".format(*self.peername))
@@ -65,41 +268,17 @@ class Server(BaseServer):
                         self.transport.close()
                         return
 
-                    mode = struct.unpack(">L", data[:4])[0]
+                    mode, port = struct.unpack(">LH", data[:INIT_LEN])
                     if mode == Mode.tcp:
-                        done = False
-                        while not done:
-                            port = random.randint(1025, 65535)
-                            try:
-                                def successful(listener: ListenerTCP):
-                                    self.listener = listener
-                                    msg = data[4:]
-                                    self.log.info("Created TCP Listener on port {}".format(port))
-                                    self.log.info("Client INIT: {}".format(msg.decode()))
-                                    self.transport.write(
-                                        compose(Command.init,
-                                                0,
-                                                struct.pack(">L", mode) + b"Successfully created a listener.")
-                                    )
-
-                                fut = asyncio.ensure_future(
-                                    self.loop.create_server(partial(ListenerTCP, self), host="", port=port)
-                                )
-
-                                fut.add_done_callback(successful)
-                            except OSError:
-                                pass
-                            else:
-                                done = True
+                        self.spawn(self.create_listener(mode, port, data[INIT_LEN:]))
 
                 if cmd == Command.data:
                     self.log.info("Received {} bytes on session {:08x}".format(len(data), sid))
                     if sid not in self.sessions:
-                        self.transport.write(compose(Command.invalid, sid, None))
-                        return
+                        self.write(compose(Command.invalid, sid, None))
+                        continue
                     session = self.get_session(sid)
                     if session:
-                        print("Server ID", id(self.sessions))
                         session.send(data)
 
         except ValueError as e:
@@ -109,19 +288,225 @@ class Server(BaseServer):
             return
 
 
-def create_server(host: str="",
-                  port: int=8000,
-                  loop: asyncio.AbstractEventLoop=None):
+class ServerGroup(BaseLoggable):
+    """
+    Protocol factory for the control port. Tracks every connected client so the whole server can be drained or
+    handed off to a new process.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop=None, limits: Limits=None, batch_window: float=0.002):
+        """
+        :param loop: asyncio event loop
+        :param limits: admission and bandwidth limits applied to every client's listener
+        :param batch_window: seconds to aggregate open/dead control packets into batches
+        """
+        self.loop = loop or asyncio.get_running_loop()
+        self.limits = limits
+        self.batch_window = batch_window
+        self.servers = set()
+        self.controls = []
+        self.adopted = defaultdict(list)
+        self.draining = False
+        self.drained = self.loop.create_future()
+        self.handoff = None
+
+    def __call__(self) -> Server:
+        return Server(self.loop, self.limits, self.batch_window, self)
+
+    @property
+    def sockets(self) -> list:
+        """
+        :return: the listening sockets of the control port
+        """
+        return [sock for control in self.controls for sock in control.sockets]
+
+    def close(self) -> None:
+        """
+        Stop accepting clients. Connected clients are not affected.
+        :return: None
+        """
+        for control in self.controls:
+            control.close()
+        self.release_adopted()
+
+    async def wait_closed(self):
+        for control in self.controls:
+            await control.wait_closed()
+
+    async def serve_forever(self):
+        """
+        Serve clients until the group has been drained, e.g. after handing off to a successor. When cancelled, the
+        control port is closed and every client is disconnected before returning.
+
+        :return: None
+        """
+        try:
+            await asyncio.shield(self.drained)
+        finally:
+            if self.handoff is not None:
+                self.handoff.cancel()
+            self.close()
+            for server in list(self.servers):
+                server.transport.close()
+            await self.wait_closed()
+
+    def adopt(self, port: int) -> list:
+        """
+        Claim the listening sockets inherited for a port
+
+        :param port: the listener port a reconnecting client asked for
+        :return: the inherited sockets (empty if there are none)
+        """
+        return self.adopted.pop(port, [])
+
+    def release_adopted(self) -> None:
+        """
+        Close inherited listener sockets that no client has reclaimed
+        :return: None
+        """
+        for port, socks in self.adopted.items():
+            self.log.info("Closing unclaimed listener on port {}".format(port))
+            for sock in socks:
+                sock.close()
+        self.adopted.clear()
+
+    def discard(self, server: Server) -> None:
+        """
+        A client disconnected
+
+        :param server: the client's Server protocol
+        :return: None
+        """
+        self.servers.discard(server)
+        if self.draining and not self.servers and not self.drained.done():
+            self.drained.set_result(None)
+
+    async def drain(self, timeout: float=None):
+        """
+        Stop accepting clients and sessions, and wait for the established sessions to finish. Clients are told to
+        reconnect. Any client still connected after `timeout` seconds is disconnected.
+
+        :param timeout: seconds to wait for sessions to finish (None waits forever)
+        :return: None
+        """
+        self.log.info("Draining {} clients".format(len(self.servers)))
+        self.draining = True
+        self.close()
+        for server in list(self.servers):
+            server.drain()
+        if not self.servers and not self.drained.done():
+            self.drained.set_result(None)
+        try:
+            await asyncio.wait_for(asyncio.shield(self.drained), timeout)
+        except asyncio.TimeoutError:
+            self.log.warning("Drain timed out, disconnecting {} clients".format(len(self.servers)))
+            for server in list(self.servers):
+                server.transport.close()
+
+    async def serve_handoff(self, path: str, timeout: float=None):
+        """
+        Wait for a new process to connect to the Unix socket at `path`, pass it the control and listener sockets,
+        then drain. The new process keeps accepting on the same ports, so reconnecting clients get their listener
+        port back without it ever being unbound.
+
+        :param path: filesystem path of the Unix socket
+        :param timeout: drain timeout once the sockets have been handed off
+        :return: None
+        """
+        with suppress(FileNotFoundError):
+            os.unlink(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        sock.listen(1)
+        sock.setblocking(False)
+        try:
+            conn, _ = await self.loop.sock_accept(sock)
+        finally:
+            sock.close()
+            with suppress(FileNotFoundError):
+                os.unlink(path)
+
+        entries = [("control", s.getsockname()[1], s) for s in self.sockets]
+        for server in self.servers:
+            for listener in server.listeners:
+                entries.extend(("listener", server.port, s) for s in listener.sockets)
+        for port, socks in self.adopted.items():
+            entries.extend(("listener", port, s) for s in socks)
+
+        self.log.info("Handing off {} sockets".format(len(entries)))
+        try:
+            conn.setblocking(True)
+            send_sockets(conn, entries)
+        finally:
+            conn.close()
+        await self.drain(timeout)
+
+
+async def create_server(host: str="",
+                        port: int=8000,
+                        loop: asyncio.AbstractEventLoop=None,
+                        limits: Limits=None,
+                        batch_window: float=0.002,
+                        handoff: str=None,
+                        drain_timeout: float=None,
+                        adopt_timeout: float=30.0,
+                        tunnel: Tunnel=Tunnel.tcp,
+                        congestion: Callable[[], CongestionControl]=None,
+                        ssl: SSLContext=None):
     """
     Creates server sockets bound to a specific address:port supporting the protocols provided
 
     :param port: local port to bind
     :param host: local host to bind
     :param loop: asyncio event loop
-    :return:
+    :param limits: admission and bandwidth limits applied to every client's listener
+    :param batch_window: seconds to aggregate open/dead control packets into batches
+    :param handoff: path of a Unix socket used for zero-downtime restarts. If a running server is serving a handoff
+                    on this path, its sockets are taken over. Either way, this server then serves the handoff for
+                    its own successor.
+    :param drain_timeout: seconds to let sessions finish after handing off to a successor
+    :param adopt_timeout: seconds to keep inherited listener sockets for their clients to reconnect
+    :param tunnel: transport for the Client-to-Server connections (TCP, or UDP to avoid head-of-line blocking)
+    :param congestion: congestion controller factory for UDP tunnels (defaults to NewReno)
+    :param ssl: server-side SSLContext to run the tunnel over TLS. Session tickets are left enabled so reconnecting
+                clients can resume their session.
+    :return: the ServerGroup
     """
-    loop = loop or asyncio.get_event_loop()
-    server = loop.create_server(Server, host=host, port=port, reuse_address=True)
+    loop = loop or asyncio.get_running_loop()
     log = make_logger()
-    log.info("Server Created on {}:{}".format(host, port))
-    return server
+    group = ServerGroup(loop, limits, batch_window)
+
+    if tunnel == Tunnel.udp:
+        if handoff is not None:
+            raise ValueError("Socket handoff requires a TCP tunnel")
+        if ssl is not None:
+            raise ValueError("TLS requires a TCP tunnel")
+        group.controls.append(await serve_tunnel(group, host, port, loop=loop, congestion=congestion))
+        log.info("Server Created on {}:{} (UDP)".format(host, port))
+        return group
+
+    inherited = []
+    if handoff is not None:
+        try:
+            # Blocks until the running process answers (or times out), so keep it off the event loop
+            inherited = await loop.run_in_executor(None, receive_sockets, handoff)
+        except (OSError, ValueError) as e:
+            log.info("No server to take over from at {}: {}".format(handoff, e))
+
+    for (kind, sock_port, sock) in inherited:
+        if kind == "control":
+            group.controls.append(await loop.create_server(group, sock=sock, ssl=ssl))
+        else:
+            group.adopted[sock_port].append(sock)
+
+    if group.controls:
+        log.info("Server Taken Over on {} ({} listeners)".format(
+            ", ".join("{}:{}".format(*sock.getsockname()[:2]) for sock in group.sockets), len(group.adopted)))
+        loop.call_later(adopt_timeout, group.release_adopted)
+    else:
+        group.controls.append(await loop.create_server(group, host=host, port=port, reuse_address=True, ssl=ssl))
+        log.info("Server Created on {}:{}".format(host, port))
+
+    if handoff is not None:
+        group.handoff = loop.create_task(group.serve_handoff(handoff, drain_timeout))
+    return group
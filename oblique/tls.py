@@ -0,0 +1,64 @@
+import ssl
+
+"""
+TLS support for the Client-to-Server connection
+"""
+
+__all__ = ["RECORD_SIZE", "SessionCache", "enable_resumption"]
+
+RECORD_SIZE = 16384     # Largest TLS record payload. Small packets are coalesced up to this size.
+
+
+class SessionCache(object):
+    """
+    Remembers the most recent TLS session for each server, so a reconnecting client can resume it instead of
+    performing a full handshake.
+    """
+
+    def __init__(self):
+        self.sessions = dict()
+
+    def get(self, server_hostname: str):
+        """
+        :param server_hostname: the server name the connection is made to
+        :return: the last session for the server, or None
+        """
+        return self.sessions.get(server_hostname, None)
+
+    def store(self, ssl_object: ssl.SSLObject) -> None:
+        """
+        Remember the session of an established connection. With TLS 1.3 the session ticket arrives after the
+        handshake, so this should be called once the server has sent application data.
+
+        :param ssl_object: the connection's SSLObject
+        :return: None
+        """
+        session = ssl_object.session
+        if session is not None and session.has_ticket:
+            self.sessions[ssl_object.server_hostname] = session
+
+
+def enable_resumption(context: ssl.SSLContext) -> SessionCache:
+    """
+    Make client connections created with `context` offer the last stored session for their server. Safe to call
+    more than once for the same context.
+
+    :param context: a client-side SSLContext
+    :return: the context's session cache
+    """
+    cache = getattr(context, "oblique_sessions", None)
+    if cache is not None:
+        return cache
+
+    cache = SessionCache()
+    wrap_bio = context.wrap_bio
+
+    def resuming_wrap_bio(incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if session is None and not server_side:
+            session = cache.get(server_hostname)
+        return wrap_bio(incoming, outgoing, server_side=server_side, server_hostname=server_hostname,
+                        session=session)
+
+    context.wrap_bio = resuming_wrap_bio
+    context.oblique_sessions = cache
+    return cache
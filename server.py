@@ -1,29 +1,18 @@
 #!/usr/bin/env python3
-import asyncio
-try:
-    import uvloop
-    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
-except ImportError as e:
-    print("Running without uvloop")
-
 import oblique
 
 SERVER_HOST = "localhost"
 SERVER_PORT = 8000
 
 
-@asyncio.coroutine
-def main(loop):
+async def main():
     try:
-        yield from oblique.create_server(host=SERVER_HOST, port=SERVER_PORT, loop=loop)
+        group = await oblique.create_server(host=SERVER_HOST, port=SERVER_PORT)
     except Exception as e:
         print(e)
+        return
+    await group.serve_forever()
 
 
 if __name__ == "__main__":
-    loop = asyncio.get_event_loop()
-    try:
-        loop.run_until_complete(main(loop))
-        loop.run_forever()
-    finally:
-        loop.close()
+    oblique.run(main())
@@ -0,0 +1,65 @@
+import struct
+import unittest
+
+from oblique.commands import Command, MAGIC_HEADER, MAX_LENGTH, compose, compose_batch, parse, parse_batch, \
+    parse_partial
+
+"""
+Packet composition and parsing
+"""
+
+
+class TestBatches(unittest.TestCase):
+    def test_round_trip(self):
+        packet = compose_batch(Command.dead, [1, 2, 0xFFFFFFFF])
+        [(cmd, sid, data)] = parse(packet)
+        self.assertEqual(cmd, Command.dead_batch)
+        self.assertEqual(sid, 0)
+        self.assertEqual(parse_batch(data), (1, 2, 0xFFFFFFFF))
+
+    def test_single_session_is_plain_command(self):
+        self.assertEqual(compose_batch(Command.open, [7]), compose(Command.open, 7, None))
+
+    def test_invalid_batch_length(self):
+        packet = compose(Command.open_batch, 0, b"\x00" * 6)
+        with self.assertRaises(ValueError):
+            list(parse(packet))
+
+
+class TestParsePartial(unittest.TestCase):
+    def test_complete_commands(self):
+        stream = compose(Command.data, 1, b"hello") + compose(Command.eof, 1, None)
+        commands, consumed = parse_partial(stream)
+        self.assertEqual(commands, [(Command.data, 1, b"hello"), (Command.eof, 1, b"")])
+        self.assertEqual(consumed, len(stream))
+
+    def test_split_command_is_left_for_the_next_read(self):
+        first = compose(Command.data, 1, b"hello")
+        second = compose(Command.data, 2, b"world")
+        stream = bytearray(first + second[:-2])
+        commands, consumed = parse_partial(stream)
+        self.assertEqual(commands, [(Command.data, 1, b"hello")])
+        self.assertEqual(consumed, len(first))
+
+        del stream[:consumed]
+        stream.extend(second[-2:])
+        commands, consumed = parse_partial(stream)
+        self.assertEqual(commands, [(Command.data, 2, b"world")])
+        self.assertEqual(consumed, len(second))
+
+    def test_over_length_is_rejected_from_the_header(self):
+        header = struct.pack(">LBLL", MAGIC_HEADER, Command.data, 1, MAX_LENGTH + 1)
+        with self.assertRaises(ValueError):
+            parse_partial(header)
+
+    def test_max_length_waits_for_the_rest(self):
+        header = struct.pack(">LBLL", MAGIC_HEADER, Command.data, 1, MAX_LENGTH)
+        self.assertEqual(parse_partial(header), ([], 0))
+
+    def test_invalid_header(self):
+        with self.assertRaises(ValueError):
+            parse_partial(b"\x00" * 13)
+
+
+if __name__ == "__main__":
+    unittest.main()
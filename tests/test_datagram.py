@@ -0,0 +1,190 @@
+import asyncio
+import struct
+import unittest
+
+from oblique.commands import Command, compose, parse
+from oblique.congestion import NewReno
+from oblique.datagram import DatagramTunnel, DUP_THRESH, RECV_WINDOW, TOMBSTONE_TTL
+
+"""
+Datagram tunnel state machine, driven by a fake event loop and a fake sendto
+"""
+
+
+class FakeHandle(object):
+    def __init__(self, callback, args):
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeLoop(object):
+    """
+    Just enough of an event loop for a DatagramTunnel. Timers never fire on their own; tests call tick().
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.ready = []
+
+    def time(self):
+        return self.now
+
+    def call_soon(self, callback, *args):
+        handle = FakeHandle(callback, args)
+        self.ready.append(handle)
+        return handle
+
+    def call_later(self, delay, callback, *args):
+        return FakeHandle(callback, args)
+
+    def run_ready(self):
+        while self.ready:
+            handle = self.ready.pop(0)
+            if not handle.cancelled:
+                handle.callback(*handle.args)
+
+
+class Recorder(asyncio.Protocol):
+    def __init__(self):
+        self.packets = []
+
+    def data_received(self, data):
+        self.packets.extend(parse(data))
+
+    def connection_lost(self, exc):
+        pass
+
+
+def segment(sid, seq, cmd=Command.data, data=b"x"):
+    return compose(Command.seg, sid, struct.pack(">L", seq) + compose(cmd, sid, data))
+
+
+def ack(sid, cumulative, *blocks):
+    return compose(Command.ack, sid, struct.pack(">L", cumulative) + b"".join(struct.pack(">LL", *b) for b in blocks))
+
+
+class TunnelTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = FakeLoop()
+        self.sent = []
+        self.tunnel = DatagramTunnel(self.loop, self.sent.append, ("127.0.0.1", 1), ("127.0.0.1", 2), NewReno())
+        self.protocol = Recorder()
+        self.tunnel.set_protocol(self.protocol)
+
+    def receive(self, *packets):
+        self.tunnel.datagram_received(b"".join(packets))
+        self.loop.run_ready()
+
+    def sent_packets(self):
+        packets = [packet for datagram in self.sent for packet in parse(datagram)]
+        self.sent.clear()
+        return packets
+
+    def sent_acks(self):
+        acks = {}
+        for (cmd, sid, payload) in self.sent_packets():
+            if cmd == Command.ack:
+                cumulative = struct.unpack(">L", payload[:4])[0]
+                blocks = [struct.unpack(">LL", payload[i:i+8]) for i in range(4, len(payload), 8)]
+                acks[sid] = (cumulative, blocks)
+        return acks
+
+    def sent_segments(self):
+        return [(sid, struct.unpack(">L", payload[:4])[0])
+                for (cmd, sid, payload) in self.sent_packets() if cmd == Command.seg]
+
+
+class TestReceive(TunnelTest):
+    def test_gap_on_one_stream_does_not_block_another(self):
+        self.receive(segment(1, 1, data=b"b"), segment(2, 0, data=b"c"))
+        self.assertEqual(self.protocol.packets, [(Command.data, 2, b"c")])
+
+        self.receive(segment(1, 0, data=b"a"))
+        self.assertEqual(self.protocol.packets[1:], [(Command.data, 1, b"a"), (Command.data, 1, b"b")])
+
+    def test_out_of_order_first_segment_is_buffered_and_acked(self):
+        self.receive(segment(3, 2), segment(3, 3))
+        self.assertEqual(self.protocol.packets, [])
+        self.assertEqual(self.sent_acks()[3], (0, [(2, 4)]))
+
+        self.receive(segment(3, 0, cmd=Command.open, data=b""), segment(3, 1))
+        self.assertEqual([cmd for (cmd, _, _) in self.protocol.packets],
+                         [Command.open, Command.data, Command.data, Command.data])
+        self.assertEqual(self.sent_acks()[3], (4, []))
+
+    def test_duplicates_and_far_segments_are_dropped(self):
+        self.receive(segment(1, 0, data=b"a"), segment(1, 0, data=b"a"), segment(1, RECV_WINDOW + 1))
+        self.assertEqual(self.protocol.packets, [(Command.data, 1, b"a")])
+        self.assertEqual(self.sent_acks()[1], (1, []))
+
+    def test_tombstone(self):
+        self.receive(segment(4, 0, cmd=Command.dead, data=b""))
+        self.assertEqual(self.protocol.packets, [(Command.dead, 4, b"")])
+
+        # A segment sent before the sender saw the session die is acknowledged, not delivered
+        self.receive(segment(4, 1))
+        self.assertEqual(len(self.protocol.packets), 1)
+        self.assertEqual(self.sent_acks()[4], (2, []))
+
+        # Once the tombstone expires, late retransmissions are ignored without recreating the stream
+        self.loop.now += TOMBSTONE_TTL + 1
+        self.tunnel.last_received = self.loop.now
+        self.tunnel.tick()
+        self.assertNotIn(4, self.tunnel.recv_streams)
+        self.receive(segment(4, 1))
+        self.assertNotIn(4, self.tunnel.recv_streams)
+        self.assertEqual(len(self.protocol.packets), 1)
+
+    def test_stream_without_first_segment_expires(self):
+        self.receive(segment(5, 1))
+        self.loop.now += TOMBSTONE_TTL + 1
+        self.tunnel.last_received = self.loop.now
+        self.tunnel.tick()
+        self.assertNotIn(5, self.tunnel.recv_streams)
+
+
+class TestSend(TunnelTest):
+    def write(self, sid, count):
+        self.tunnel.write(b"".join(compose(Command.data, sid, bytes([i])) for i in range(count)))
+        self.loop.run_ready()
+        return self.sent_segments()
+
+    def test_sack_triggers_retransmission(self):
+        self.assertEqual(self.write(1, DUP_THRESH + 2), [(1, seq) for seq in range(DUP_THRESH + 2)])
+        cwnd = self.tunnel.cc.cwnd
+
+        self.receive(ack(1, 0, (1, DUP_THRESH + 2)))
+        self.assertEqual(self.sent_segments(), [(1, 0)])
+        self.assertLess(self.tunnel.cc.cwnd, cwnd)
+
+        # The same hole is only fast retransmitted once
+        self.receive(ack(1, 0, (1, DUP_THRESH + 2)))
+        self.assertEqual(self.sent_segments(), [])
+
+    def test_early_retransmit_for_short_streams(self):
+        self.write(1, 2)
+        self.receive(ack(1, 0, (1, 2)))
+        self.assertEqual(self.sent_segments(), [(1, 0)])
+
+    def test_sack_on_one_stream_does_not_retransmit_another(self):
+        self.write(1, 1)
+        self.write(2, DUP_THRESH + 1)
+        self.receive(ack(2, DUP_THRESH + 1))
+        self.assertEqual(self.sent_segments(), [])
+        self.assertEqual(list(self.tunnel.send_streams[1].unacked), [0])
+
+    def test_timeout_retransmits(self):
+        self.write(1, 1)
+        self.loop.now += self.tunnel.rto
+        self.tunnel.last_received = self.loop.now
+        self.tunnel.tick()
+        self.loop.run_ready()
+        self.assertEqual(self.sent_segments(), [(1, 0)])
+
+
+if __name__ == "__main__":
+    unittest.main()